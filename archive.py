@@ -0,0 +1,315 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import socket
+import tarfile
+import threading
+from httplib import HTTPException
+from Queue import Queue
+from time import sleep, time
+from urllib import quote, unquote
+
+import uploader
+
+# Default number of archives sent at the same time
+DEFAULT_WORKERS = 4
+
+# Most files packed into a single archive (the most Cloud Files will
+# extract from one request)
+ARCHIVE_FILES = 10000
+
+# Most file data (in bytes) packed into a single archive, so a failed
+# request does not cost too much to send again
+ARCHIVE_SIZE = 64 * 1024 * 1024
+
+# Number of times an archive is sent before its files are given up on
+ARCHIVE_ATTEMPTS = 3
+
+# Tar archives are made of blocks of this size (in bytes)
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+class ArchiveError(Exception):
+    """
+    An archive could not be extracted (the HTTP status and response body
+    are in status and body)
+    """
+    def __init__(self, status, body=""):
+        Exception.__init__(self, "%s %s" % (status, body))
+        self.status = status
+        self.body = body
+
+
+def batches(files, max_files=ARCHIVE_FILES, max_size=ARCHIVE_SIZE):
+    """
+    Group (path, object name, size) tuples into lists of at most max_files
+    files and max_size bytes (a larger file goes in a list of its own)
+    """
+    batch, size = [], 0
+    for item in files:
+        if batch and (len(batch) == max_files or size + item[2] > max_size):
+            yield batch
+            batch, size = [], 0
+        batch.append(item)
+        size += item[2]
+    if batch:
+        yield batch
+
+
+class _TarStream(object):
+    """
+    A tar archive of a batch of files, built as it is read rather than
+    written out anywhere.  The length of the archive is known up front, so
+    it is sent with a Content-Length, and it can be started again if the
+    request has to be retried.  The MD5 of each file is taken as it goes
+    past, and the file data (not the tar headers) reported as progress.
+    """
+    def __init__(self, members, report):
+        # (tar header, path, object name, size) for each file
+        self.members = []
+        for path, name, st in members:
+            info = tarfile.TarInfo(name)
+            info.size = st.st_size
+            info.mtime = int(st.st_mtime)
+            info.mode = 0644
+            self.members.append((info.tobuf(tarfile.GNU_FORMAT), path, name,
+                                 st.st_size))
+        self.length = 2 * BLOCK_SIZE + sum(
+            len(header) + size + -size % BLOCK_SIZE
+            for header, _, _, size in self.members)
+        self.report = report
+        self.md5s = {}
+        self.seek(0)
+
+    def _parts(self):
+        for header, path, name, size in self.members:
+            yield header
+            md5 = hashlib.md5()
+            left = size
+            with open(path, "rb") as f:
+                while left:
+                    block = f.read(min(uploader.CHUNK_SIZE, left))
+                    if not block:
+                        raise IOError("'%s' shrank while being archived"
+                                      % (path))
+                    md5.update(block)
+                    left -= len(block)
+                    self.sent += len(block)
+                    self.report(len(block))
+                    yield block
+            self.md5s[name] = md5.hexdigest()
+            yield "\0" * (-size % BLOCK_SIZE)
+        yield "\0" * (2 * BLOCK_SIZE)
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            try:
+                self.buffer += next(self.parts)
+            except StopIteration:
+                break
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.pos += len(data)
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos):
+        """
+        Start the archive again (the only seek supported)
+        """
+        if pos:
+            raise IOError("Archives can only be started again")
+        if getattr(self, "sent", 0):
+            self.report(-self.sent)
+        self.parts = self._parts()
+        self.buffer = ""
+        self.pos = 0
+        # File data read so far
+        self.sent = 0
+
+
+class ArchiveUploader(uploader.Uploader):
+    """
+    Upload a directory to a container as tar archives, built on the fly
+    and extracted by Cloud Files (bulk extract-archive), each holding up to
+    ARCHIVE_FILES files.  For trees of many small files this makes a few
+    requests rather than one per file.  The files created or rejected are
+    read from the response and reported per file.
+
+    Syncing, the upload index, progress listeners and the summary work as
+    they do for an Uploader.  Large files are not segmented (each goes in
+    an archive of its own), so use an Uploader for trees of large files.
+    """
+    def __init__(self, cf, cont, workers=DEFAULT_WORKERS, remote=None,
+                 index=None, listeners=None, max_files=ARCHIVE_FILES,
+                 max_size=ARCHIVE_SIZE):
+        uploader.Uploader.__init__(self, cf, cont, workers=workers,
+                                   remote=remote, index=index,
+                                   listeners=listeners, dedup=False)
+        self.queue = Queue(workers * 2)
+        self.max_files = max_files
+        self.max_size = max_size
+        self.archives = 0
+        self.requests = 0
+
+    def _etag(self, path, size):
+        """
+        Return the ETag a file gets once extracted - files are never
+        segmented, so it is the MD5 of the whole file whatever its size
+        """
+        return uploader.file_md5(path)
+
+    def _feed(self, folder, ignore):
+        """
+        Walk the directory, queueing batches of files for the workers
+        """
+        for batch in batches(self._files(folder, ignore), self.max_files,
+                             self.max_size):
+            if self.remote is not None:
+                self.seen.update(name for _, name, _ in batch)
+            self.queue.put(batch)
+        for _ in xrange(self.workers):
+            self.queue.put(None)
+
+    def _extract(self, conn, stream):
+        """
+        Send an archive to be extracted into the container, returning the
+        response (number of files created, errors by file and so on).  The
+        request is made directly, as swiftclient has no call for it and
+        does not hand back response bodies.
+        """
+        if not conn.url or not conn.token:
+            conn.url, conn.token = conn.get_auth()
+        parsed, http = conn.http_connection()
+        http.putrequest("PUT", "%s/%s?extract-archive=tar"
+                        % (parsed.path, quote(self.container)))
+        http.putheader("X-Auth-Token", conn.token)
+        http.putheader("Accept", "application/json")
+        http.putheader("Content-Length", str(stream.length))
+        http.endheaders()
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            http.send(chunk)
+        resp = http.getresponse()
+        body = resp.read()
+        if resp.status == 401:
+            conn.url = conn.token = None
+        if not 200 <= resp.status < 300:
+            raise ArchiveError(resp.status, body)
+        result = json.loads(body)
+        status = result.get("Response Status", "")
+        # Server failures part way through mean the whole archive is sent
+        # again (files already extracted are simply overwritten)
+        if status.startswith("5"):
+            raise ArchiveError(status, result.get("Response Body", ""))
+        return result
+
+    def _upload_batch(self, conn, batch):
+        """
+        Upload a batch of files as a single archive, leaving out any that
+        are unchanged
+        """
+        start = time()
+        members = []
+        for path, name, size in batch:
+            path = os.path.abspath(path)
+            st = os.stat(path)
+            if self._unchanged(path, name, size, st):
+                with self.lock:
+                    self.skipped += 1
+                    self.skipped_bytes += size
+                self._report(size)
+                self.progress.file_done()
+            else:
+                members.append((path, name, st))
+        if not members:
+            return
+        stream = _TarStream(members, self._report)
+        for attempt in xrange(ARCHIVE_ATTEMPTS):
+            with self.lock:
+                self.requests += 1
+            try:
+                result = self._extract(conn, stream)
+                break
+            except (ArchiveError, socket.error, HTTPException) as err:
+                # Take back the progress made by the failed attempt
+                stream.seek(0)
+                if attempt == ARCHIVE_ATTEMPTS - 1:
+                    with self.lock:
+                        for path, name, st in members:
+                            self.errors[name] = err
+                    return
+                sleep(2 ** attempt)
+        # Rejected files are named by (quoted) container path, and an
+        # archive rejected as a whole names none
+        prefix = "/%s/" % (self.container)
+        failed = dict((unquote(path).replace(prefix, "", 1), status)
+                      for path, status in result.get("Errors", []))
+        status = result.get("Response Status", "")
+        if not failed and not status.startswith("2"):
+            err = ArchiveError(status, result.get("Response Body", ""))
+            failed = dict((name, err) for path, name, st in members)
+        secs = time() - start
+        with self.lock:
+            self.archives += 1
+        for path, name, st in members:
+            if name in failed:
+                with self.lock:
+                    self.errors[name] = failed[name]
+                continue
+            if self.index:
+                self.index.uploaded(path, st, stream.md5s[name],
+                                    self.container)
+            self._completed(name, st.st_size, secs)
+
+    def _work(self):
+        """
+        Worker thread body, uploading queued batches until there are none
+        left
+        """
+        conn = self._connect()
+        worker = threading.current_thread().name
+        while True:
+            self.progress.idle(worker)
+            batch = self.queue.get()
+            if batch is None:
+                break
+            self.progress.busy(worker)
+            try:
+                self._upload_batch(conn, batch)
+            except Exception as err:
+                with self.lock:
+                    for path, name, size in batch:
+                        self.errors.setdefault(name, err)
+
+    def file_rates(self):
+        """
+        Files are not sent on their own, so there are no per file rates
+        """
+        return {}
+
+    def summary(self):
+        """
+        Return lines describing the throughput and the requests made
+        """
+        lines = uploader.Uploader.summary(self)
+        lines.append("Sent %d archive(s) in %d request(s)"
+                     % (self.archives, self.requests))
+        return lines
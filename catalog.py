@@ -0,0 +1,484 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import bisect
+import cPickle as pickle
+import os
+import re
+import tempfile
+import threading
+import urllib
+from collections import namedtuple
+from ConfigParser import SafeConfigParser
+from time import time
+
+from pyrax import exceptions as e
+
+# Location of the image/flavour/zone catalog cache (one file per user and
+# region)
+CACHE_DIR = "~/.rackspace_cloud_cache"
+
+# Age (in seconds) after which cached entries are revalidated
+CATALOG_TTL = 3600
+
+# Cache file layout version, bumped whenever the record layout changes
+CACHE_VERSION = 1
+
+# Flavours offered when nothing has been cached for the region yet
+DEFAULT_FLAVOURS = [
+                    "512MB Standard",
+                    "1GB Standard",
+                    "2GB Standard",
+                    "4GB Standard",
+                    "8GB Standard",
+                    "15GB Standard",
+                    "30GB Standard",
+                    "1 GB Performance",
+                    "2 GB Performance",
+                    "4 GB Performance",
+                    "8 GB Performance",
+                    "15 GB Performance",
+                    "30 GB Performance",
+                    "60 GB Performance",
+                    "90 GB Performance",
+                    "120 GB Performance"
+                    ]
+
+# Cloud DB flavour sizes (MB) offered when nothing has been cached
+DEFAULT_DB_FLAVOURS = [512, 1024, 2048, 4096, 8192, 16384]
+
+# Compact catalog records, stored on disk as plain tuples
+Image = namedtuple("Image", "id name status created type")
+Flavor = namedtuple("Flavor", "id name ram")
+Domain = namedtuple("Domain", "id name")
+
+
+def _image_record(img):
+    """
+    Return the catalog record for an image returned by the API
+    """
+    return tuple(Image(img.id, img.name, img.status,
+                       getattr(img, "created", ""),
+                       "snapshot" if hasattr(img, "server") else "base"))
+
+
+def _fetch_images(cs):
+    """
+    Return all images visible to the account as catalog records
+    """
+    return [_image_record(i) for i in cs.images.list()]
+
+
+def _tokens(name):
+    """
+    Split an image name into lower case word tokens
+    """
+    return re.findall(r"[a-z0-9.]+", name.lower())
+
+
+def _fetch_flavors(cs):
+    """
+    Return all Cloud Server flavours as catalog records
+    """
+    return [tuple(Flavor(f.id, f.name, f.ram)) for f in cs.flavors.list()]
+
+
+def _fetch_db_flavors(cdb):
+    """
+    Return all Cloud DB flavours as catalog records
+    """
+    return [tuple(Flavor(f.id, f.name, f.ram)) for f in cdb.list_flavors()]
+
+
+def _fetch_domains(dns):
+    """
+    Return every DNS zone on the account as catalog records, fetched a page
+    at a time
+    """
+    return [tuple(Domain(d.id, d.name.lower()))
+            for d in dns.get_domain_iterator()]
+
+
+def _labels(name):
+    """
+    Return the labels of a DNS name from the top level domain down
+    """
+    return name.lower().rstrip(".").split(".")[::-1]
+
+
+def peek_region(default="ORD"):
+    """
+    Determine the region requested on the command line ahead of full
+    argument parsing, so cached choices can be offered for it
+    """
+    p = argparse.ArgumentParser(add_help=False)
+    p.add_argument("-r", "--region", action="store", type=str,
+                   default=default)
+    args, _ = p.parse_known_args()
+    return args.region
+
+
+def cache_path(creds_file, region):
+    """
+    Return the cache file location for the user in the credentials file and
+    the region provided
+    """
+    username = "default"
+    cfg = SafeConfigParser()
+    try:
+        if cfg.read(os.path.expanduser(creds_file)):
+            for section in ["rackspace_cloud", "keystone"]:
+                if cfg.has_option(section, "username"):
+                    username = cfg.get(section, "username")
+                    break
+    except Exception:
+        pass
+    return os.path.join(os.path.expanduser(CACHE_DIR),
+                        "%s-%s.catalog" % (username, region.upper()))
+
+
+def _load(path):
+    """
+    Read a cache file, returning an empty catalog if missing or unusable
+    """
+    try:
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("version") == CACHE_VERSION:
+            return data
+    except Exception:
+        pass
+    return {"version": CACHE_VERSION, "sections": {}}
+
+
+def flavour_names(creds_file, region):
+    """
+    Return cached Cloud Server flavour names for the region (no API calls)
+    """
+    entry = _load(cache_path(creds_file, region))["sections"].get("flavors")
+    if not entry:
+        return DEFAULT_FLAVOURS
+    return [Flavor(*f).name for f in entry[1]]
+
+
+def db_flavour_sizes(creds_file, region):
+    """
+    Return cached Cloud DB flavour sizes for the region (no API calls)
+    """
+    entry = _load(cache_path(creds_file, region))["sections"].get(
+                  "db_flavors")
+    if not entry:
+        return DEFAULT_DB_FLAVOURS
+    return sorted(set(Flavor(*f).ram for f in entry[1]))
+
+
+class Catalog(object):
+    """
+    Per-region image, flavour and DNS zone catalog backed by an on-disk
+    cache.
+
+    Fresh entries are served straight from disk.  Stale entries are served
+    as well, while a background thread refreshes them for the next run.  A
+    section not cached yet is fetched live and written out.
+    """
+    def __init__(self, creds_file, region, cs=None, cdb=None, dns=None,
+                 ttl=CATALOG_TTL):
+        self.path = cache_path(creds_file, region)
+        self.ttl = ttl
+        self.fetchers = {"images": (_fetch_images, cs),
+                         "flavors": (_fetch_flavors, cs),
+                         "db_flavors": (_fetch_db_flavors, cdb),
+                         "domains": (_fetch_domains, dns)}
+        self.lock = threading.Lock()
+        self.revalidating = set()
+        self.data = _load(self.path)
+
+    def _save(self, section, records):
+        """
+        Store a refreshed section, merging with whatever other processes may
+        have written in the meantime, and replace the cache file atomically
+        """
+        with self.lock:
+            data = _load(self.path)
+            data["sections"][section] = (time(), records)
+            self.data = data
+            cache_dir = os.path.dirname(self.path)
+            try:
+                os.makedirs(cache_dir, 0700)
+            except OSError:
+                pass
+            fd, tmp = tempfile.mkstemp(dir=cache_dir)
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+                os.rename(tmp, self.path)
+            except Exception:
+                os.unlink(tmp)
+                raise
+
+    def _refresh(self, section):
+        """
+        Fetch a section live and update the cache
+        """
+        fetch, client = self.fetchers[section]
+        records = fetch(client)
+        self._save(section, records)
+        return records
+
+    def _revalidate(self, section):
+        """
+        Background refresh, failures simply leave the stale entry in place
+        """
+        try:
+            self._refresh(section)
+        except Exception:
+            pass
+
+    def _background(self, section):
+        """
+        Refresh a section on a background thread, unless already under way
+        """
+        if section not in self.revalidating:
+            self.revalidating.add(section)
+            threading.Thread(target=self._revalidate, args=(section,)).start()
+
+    def prefetch(self, section):
+        """
+        Fetch a section not cached yet in the background, so later runs
+        find it on disk
+        """
+        if not self.cached(section):
+            self._background(section)
+
+    def cached(self, section):
+        """
+        Determine whether a section is available without any API calls
+        """
+        return section in self.data["sections"]
+
+    def _get(self, section):
+        """
+        Return the records for a section, honouring the TTL
+        """
+        entry = self.data["sections"].get(section)
+        if entry is None:
+            return self._refresh(section)
+        fetched, records = entry
+        if time() - fetched > self.ttl:
+            self._background(section)
+        return records
+
+    def images(self):
+        """
+        Return all images as Image records
+        """
+        return [Image(*i) for i in self._get("images")]
+
+    def flavors(self):
+        """
+        Return all Cloud Server flavours as Flavor records
+        """
+        return [Flavor(*f) for f in self._get("flavors")]
+
+    def db_flavors(self):
+        """
+        Return all Cloud DB flavours as Flavor records
+        """
+        return [Flavor(*f) for f in self._get("db_flavors")]
+
+    def domains(self):
+        """
+        Return all DNS zones as Domain records
+        """
+        return [Domain(*d) for d in self._get("domains")]
+
+
+class ImageIndex(object):
+    """
+    Lookup structures over a list of Image records: an exact name hash, a
+    sorted name list for prefix searches and an inverted word token index.
+    Candidates are always ordered the same way - snapshots before base
+    images, newest first, with the image ID as a tie breaker.
+    """
+    def __init__(self, images):
+        self.by_name = {}
+        self.tokens = {}
+        for img in images:
+            if img.status not in ["ACTIVE"]:
+                continue
+            self.by_name.setdefault(img.name, []).append(img)
+            for token in _tokens(img.name):
+                self.tokens.setdefault(token, set()).add(img)
+        self.names = sorted(self.by_name)
+
+    @staticmethod
+    def _best(candidates):
+        """
+        Return the preferred image out of a group of candidates
+        """
+        return max(candidates,
+                   key=lambda i: (i.type == "snapshot", i.created, i.id))
+
+    def exact(self, name):
+        """
+        Return the image with exactly the name provided, or None
+        """
+        matches = self.by_name.get(name)
+        return self._best(matches) if matches else None
+
+    def prefix(self, name):
+        """
+        Return the preferred image whose name starts with the one provided
+        """
+        matches = []
+        pos = bisect.bisect_left(self.names, name)
+        while pos < len(self.names) and self.names[pos].startswith(name):
+            matches.extend(self.by_name[self.names[pos]])
+            pos += 1
+        return self._best(matches) if matches else None
+
+    def words(self, name):
+        """
+        Return the preferred image whose name contains every word provided
+        """
+        matches = None
+        for token in _tokens(name):
+            found = self.tokens.get(token, set())
+            matches = found if matches is None else matches & found
+            if not matches:
+                return None
+        return self._best(matches) if matches else None
+
+    def resolve(self, name):
+        """
+        Return the best match for an image name: an exact match, then a
+        name prefix match, then a match on all words
+        """
+        return self.exact(name) or self.prefix(name) or self.words(name)
+
+
+def resolve_image(cat, cs, name):
+    """
+    Locate an image by name, returning an Image record or None.  When the
+    image list is not cached, an exact name match is first requested with
+    a server side filter so the full list is only downloaded (and cached)
+    when the name is partial.
+    """
+    if not cat.cached("images"):
+        query = urllib.urlencode({"name": name, "status": "ACTIVE"})
+        found = cs.images._list("/images/detail?%s" % (query), "images")
+        match = ImageIndex([Image(*_image_record(i))
+                            for i in found]).resolve(name)
+        if match:
+            return match
+    return ImageIndex(cat.images()).resolve(name)
+
+
+class ZoneIndex(object):
+    """
+    Suffix trie over a list of Domain records, keyed by label from the top
+    level domain down, so the zone a name belongs in is found in one step
+    per label however many zones there are.  The longest zone name wins,
+    so names in a delegated sub-zone (sub.example.com as well as
+    example.com) resolve to the sub-zone.
+    """
+    def __init__(self, domains):
+        self.root = {}
+        for dom in domains:
+            node = self.root
+            for label in _labels(dom.name):
+                node = node.setdefault(label, {})
+            # Labels are never empty, so the empty key marks a zone
+            node[""] = dom
+
+    def zone(self, fqdn):
+        """
+        Return the Domain record of the zone a name belongs in, or None
+        """
+        found = None
+        node = self.root
+        for label in _labels(fqdn):
+            node = node.get(label)
+            if node is None:
+                break
+            found = node.get("", found)
+        return found
+
+
+def _filter_zone(dns, labels, longest, shortest=2):
+    """
+    Look up the suffixes of a name (as labels from the top level domain
+    down) from longest to shortest label count with the server side name
+    filter, returning the first domain found or None
+    """
+    for count in xrange(longest, shortest - 1, -1):
+        found = dns.findall(name=".".join(reversed(labels[:count])))
+        if found:
+            return found[0]
+    return None
+
+
+def resolve_zone(cat, dns, fqdn):
+    """
+    Locate the zone a name belongs in (the longest zone name it ends with),
+    returning the domain or None.  Suffixes of the name longer than the
+    zone found in the cached zone list are first looked up with a server
+    side name filter (a request per label), so a sub-zone created since
+    the list was cached is still found.  When the list is not cached yet,
+    or the cached zone is gone, every suffix is looked up that way (and
+    the list is cached in the background for the next run).
+    """
+    labels = _labels(fqdn)
+    if not cat.cached("domains"):
+        cat.prefetch("domains")
+        return _filter_zone(dns, labels, len(labels))
+    match = ZoneIndex(cat.domains()).zone(fqdn)
+    if match is None:
+        return _filter_zone(dns, labels, len(labels))
+    depth = len(_labels(match.name))
+    found = _filter_zone(dns, labels, len(labels), depth + 1)
+    if found:
+        return found
+    try:
+        return dns.get(match.id)
+    except e.NotFound:
+        return _filter_zone(dns, labels, depth)
+
+
+def resolve_zones(cat, dns, names):
+    """
+    Locate the zones a batch of names belong in, returning the domains by
+    name (names with no zone are left out).  The zone list is used in full
+    (fetched and cached if need be, and fetched again if some names are
+    left over and it came from the cache), and each zone found is fetched
+    once, so the requests made depend on the number of zones rather than
+    the number of names.
+    """
+    fresh = not cat.cached("domains")
+    while True:
+        index = ZoneIndex(cat.domains())
+        matches = dict((n, index.zone(n)) for n in names)
+        if fresh or all(matches.values()):
+            break
+        cat._refresh("domains")
+        fresh = True
+    domains = {}
+    for match in set(m for m in matches.values() if m):
+        try:
+            domains[match.id] = dns.get(match.id)
+        except e.NotFound:
+            pass
+    return dict((n, domains[m.id]) for n, m in matches.iteritems()
+                if m and m.id in domains)
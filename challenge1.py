@@ -17,11 +17,17 @@
 import argparse
 import os
 from sys import exit
-from time import sleep
 
 import pyrax
 from pyrax import exceptions as e
 
+import catalog
+import engine
+import fleet
+import ratelimit
+import regions
+import tokencache
+
 # Location of pyrax configuration file
 CONFIG_FILE = "~/.rackspace_cloud_credentials"
 
@@ -39,27 +45,9 @@ def main():
     ERRORS = False
 
     # Compile a list of available flavours for use in argument parsing
-    # later on. The choices permitted will be made up of this list.
-    #    NOTE: Should revisit to make more dynamic and account for any
-    #          flavour updates
-    FLAVOUR_LIST = [
-                    "512MB Standard", 
-                    "1GB Standard",
-                    "2GB Standard",
-                    "4GB Standard",
-                    "8GB Standard",
-                    "15GB Standard",
-                    "30GB Standard",
-                    "1 GB Performance",
-                    "2 GB Performance",
-                    "4 GB Performance",
-                    "8 GB Performance",
-                    "15 GB Performance",
-                    "30 GB Performance",
-                    "60 GB Performance",
-                    "90 GB Performance",
-                    "120 GB Performance"
-                    ]
+    # later on. The choices permitted are taken from the cached catalog for
+    # the requested region (a default list is used if nothing is cached).
+    FLAVOUR_LIST = catalog.flavour_names(CONFIG_FILE, catalog.peek_region())
     
     # Define the script parameters (all are optional for the time being)
     parser = argparse.ArgumentParser(description=("Cloud Server provisioning "
@@ -87,11 +75,74 @@ def main():
     parser.add_argument("-c", "--count", action="store", required=False,
                         metavar="[count]", type=int,
                         help="Number of servers to build (defaults to 3)",
-                        choices=range(1,11), default=3)
+                        default=3)
+    parser.add_argument("-n", "--names", action="store", required=False,
+                        metavar="[name pattern]", type=str,
+                        help=("Server name pattern, with numeric ranges in "
+                              "braces (e.g. web{001..500}). Overrides the "
+                              "prefix flag, count defaults to the number of "
+                              "names"))
+    parser.add_argument("-b", "--batch", action="store", required=False,
+                        metavar="[batch size]", type=int,
+                        help=("Number of build requests issued together "
+                              "(defaults to %d)" % (engine.DEFAULT_BATCH)),
+                        default=engine.DEFAULT_BATCH)
+    parser.add_argument("-w", "--window", action="store", required=False,
+                        metavar="[in-flight builds]", type=int,
+                        help=("Maximum number of builds in progress at any "
+                              "one time (defaults to %d)"
+                              % (engine.DEFAULT_WINDOW)),
+                        default=engine.DEFAULT_WINDOW)
+
+    parser.add_argument("-R", "--regions", action="store", required=False,
+                        metavar="[region list]", type=str,
+                        help=("Comma separated regions to build in at the "
+                              "same time, each with an optional server "
+                              "count (e.g. ORD:3,DFW,IAD:5). Overrides the "
+                              "region flag, count defaults to the count "
+                              "flag"))
 
     # Parse arguments (validate user input)
     args = parser.parse_args()
 
+    # Server names come from the name pattern if provided, otherwise they
+    # are numbered from the prefix (prefix1, prefix2, ...)
+    if args.names:
+        try:
+            names = fleet.expand_names(args.names)
+        except ValueError as err:
+            print "ERROR: Name pattern is incorrectly formatted -", err
+            exit(5)
+        args.count = len(names)
+    elif args.count < 1:
+        print "ERROR: Server count must be at least 1"
+        exit(5)
+    else:
+        names = [args.prefix + str(count + 1) for count in xrange(args.count)]
+
+    if args.batch < 1 or args.window < 1:
+        print "ERROR: Batch size and in-flight builds must be at least 1"
+        exit(5)
+
+    # Determine the regions (and server count for each) to build in.
+    # Without a region list this is just the single region requested.
+    if args.regions:
+        try:
+            plan = regions.region_plan(args.regions, args.count)
+        except ValueError as err:
+            print "ERROR: Region list is incorrectly formatted -", err
+            exit(5)
+        # Region counts beyond the name pattern have no names to use
+        if args.names and [c for r, c in plan if c > len(names)]:
+            print ("ERROR: Server count per region exceeds the %d names in "
+                   "the pattern" % (len(names)))
+            exit(5)
+        # Without a pattern, names run on for the larger region counts
+        names = names + [args.prefix + str(count + 1) for count in
+                         xrange(len(names), max(c for r, c in plan))]
+    else:
+        plan = [(args.region, args.count)]
+
     # Define the authentication credentials file location and request that
     # pyrax makes use of it. If not found, let the client/user know about it.
 
@@ -104,7 +155,7 @@ def main():
     try:
         creds_file = os.path.expanduser(CONFIG_FILE)
         pyrax.set_setting("identity_type", IDENTITY_TYPE)
-        pyrax.set_credential_file(creds_file, args.region)
+        tokencache.authenticate(creds_file, plan[0][0])
     except e.AuthenticationFailed:
         print ("ERROR: Authentication failed. Please check and confirm "
                "that the API username, key, and region are in place "
@@ -114,74 +165,88 @@ def main():
         print "ERROR: Credentials file '%s' not found" % (creds_file)
         exit(2)
 
-    # Use a shorter Cloud Servers class reference string
-    # This simplifies invocation later on (less typing)
-    cs = pyrax.cloudservers
+    # Resolve the image and flavour for every region ahead of the builds,
+    # each region having its own Cloud Servers client and catalog
+    jobs = {}
+    limiters = {}
+    for region, count in plan:
+        cs = pyrax.connect_to_cloudservers(region=region)
 
-    # Locate the image to build from (confirm it exists)
-    try:
-        image = [i for i in cs.images.list() if args.image in i.name][0]
-    except:
-        print ("ERROR: Image name provided has not matched any entries. "
-               "Please check and try again.")
-        exit(3)
-
-    # Grab the flavor ID from the RAM amount selected by the user.
-    # The server create request requires the ID rather than RAM amount.
-    try:
-        flavour = [f for f in cs.flavors.list() if args.flavour == f.name][0]
-    except:
-        print ("ERROR: Flavor name provided has not matched any entries. "
-               "Please check and try again.")
-        exit(4)
+        # Pace requests in the region according to the account's limits,
+        # queueing them rather than having builds fail as over limit
+        limiters[region] = ratelimit.Scheduler.for_client(cs)
+
+        # Image and flavour details are served from the local catalog cache
+        cat = catalog.Catalog(CONFIG_FILE, region, cs=cs)
+
+        # Locate the image to build from (confirm it exists)
+        try:
+            image = catalog.resolve_image(cat, cs, args.image)
+        except:
+            image = None
+        if image is None:
+            print ("ERROR: Image name provided has not matched any entries "
+                   "in %s. Please check and try again." % (region))
+            exit(3)
+
+        # Grab the flavor ID from the RAM amount selected by the user.
+        # The server create request requires the ID rather than RAM amount.
+        try:
+            flavour = [f for f in cat.flavors() if args.flavour == f.name][0]
+        except:
+            print ("ERROR: Flavor name provided has not matched any entries "
+                   "in %s. Please check and try again." % (region))
+            exit(4)
+
+        # Confirm the account has room for the build before starting it
+        problems = fleet.preflight(limiters[region].absolute, count, flavour)
+        if problems:
+            for problem in problems:
+                print ("ERROR: Build in %s exceeds account limits - %s"
+                       % (region, problem))
+            exit(6)
+
+        jobs[region] = (cs, image, flavour, names[:count], args.batch,
+                        args.window)
 
     print ("Cloud Server build request initiated\n"
            "TIP: You may wish to check available options by issuing "
-           "the -h/--help flag\n")
+           "the -h/--help flag")
 
     # Print the image ID and name selected, as well as the server count
-    print "-- Image details\n\tID: %s\n\tName: %s" % (image.id, image.name)
-    print ("\n-- Server build details\n\tFlavour: %s\n\tCount: %d"
-           % (flavour.name, args.count))
-
-    # Server list definition to be used in tracking build status/comletion
-    servers = []
-
-    # Iterate through the server count specified, sending the build request
-    # for each one in turn (concurrent builds)
-    for count in xrange(args.count):
-        # Issue the server creation request
-        srv = cs.servers.create(args.prefix + str(count + 1),
-                                   image.id, flavour.id)
-        # Add server ID from the create request to the tracking list
-        servers.append(srv)
-
-    # Check on the status of the server builds. Completed or error/unknown
-    # states are removed from the list until nothing remains.
-    while servers:
-        # Track the element position for 'more efficient' removal
-        count = 0
-        for server in servers:
-            # Get the updated server details
-            server.get()
-            # Should it meet the necessary criteria, provide extended info
-            # and remove from the list
-            if server.status in ["ACTIVE", "ERROR", "UNKNOWN"]:
-                print ("\n-- Server details:\n\tName: %s\n\tStatus: %s"
-                       "\n\tAdmin password: %s"
-                      % (server.name, server.status, server.adminPass))
-                print ("\tNetworks:\n\t\tPublic #1: %s\n\t\t"
-                       "Public #2: %s\n\t\tPrivate: %s"
-                       % (server.networks["public"][0],
-                          server.networks["public"][1],
-                          server.networks["private"][0]))
-                if server.status not in ["ACTIVE"]:
-                    ERRORS = True
-                    print "WARN: Something went wrong with the build request"
-                del servers[count]
-            count += 1
-        # Reasonable wait period between checks
-        sleep(15)
+    for region, count in plan:
+        cs, image, flavour = jobs[region][:3]
+        print ("\n-- %s image details\n\tID: %s\n\tName: %s"
+               % (region, image.id, image.name))
+        print ("\n-- %s server build details\n\tFlavour: %s\n\tCount: %d"
+               % (region, flavour.name, count))
+
+    # Run the builds in all regions at the same time, reporting on each
+    # server as soon as its build completes (in whichever region)
+    builds = regions.FanOut(engine.build_region, jobs)
+    for region, server in builds:
+        print ("\n-- Server details:\n\tRegion: %s\n\tName: %s\n\t"
+               "Status: %s\n\tAdmin password: %s"
+              % (region, server.name, server.status, server.adminPass))
+        if server.status not in ["ACTIVE"]:
+            ERRORS = True
+            print "WARN: Something went wrong with the build request"
+        else:
+            print ("\tNetworks:\n\t\tPublic #1: %s\n\t\t"
+                   "Public #2: %s\n\t\tPrivate: %s"
+                   % (server.networks["public"][0],
+                      server.networks["public"][1],
+                      server.networks["private"][0]))
+
+    # Per region wall time (and failure) summary
+    print "\n-- Region build times"
+    for region, count in plan:
+        print ("\t%s: %.1fs (%.1fs throttled by rate limits)"
+               % (region, builds.timings[region], limiters[region].throttled))
+        if region in builds.errors:
+            ERRORS = True
+            print ("WARN: Build requests in %s failed: %s"
+                   % (region, builds.errors[region]))
 
     # All done
     exit_msg = "\nBuild requests completed successfully"
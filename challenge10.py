@@ -18,12 +18,18 @@ import argparse
 import os
 import socket
 from sys import exit
-from time import sleep
 
 import pyrax
 from pyrax import exceptions as e
 from novaclient import exceptions as exc
 
+import catalog
+import dnsrecords
+import engine
+import fleet
+import ratelimit
+import tokencache
+
 # Location of pyrax configuration file
 CONFIG_FILE = "~/.rackspace_cloud_credentials"
 
@@ -33,15 +39,6 @@ IDENTITY_TYPE = "rackspace"
 # Default TTL value
 DEFAULT_TTL = 300
 
-def zone_list(obj):
-    """
-    Return all zones under an account
-    """
-    # Get and return the zone list
-    doms = obj.list()
-    return doms
-
-
 def is_int(val, limit):
     """
     Determine if value provided is an integer greater than or equal to limit
@@ -72,16 +69,15 @@ def is_valid_ipv4(address):
     return True
 
 
-def check_lb_status(obj):
+def check_lb_status(clb, obj, wait_for_change=False):
     """
     Check LB status and freak out if not active
     """
     # We need to confirm that the LB is active before making any
-    # additional changes, 10 second sleep is more than reasonable
-    while obj.status not in ["ACTIVE", "ERROR"]:
-        sleep(10)
-        obj.get()
-        
+    # additional changes, 10 second sleep is more than reasonable.
+    # Only LBs changed since the previous check are requested each time.
+    obj = engine.wait_for_lb(clb, obj, wait_for_change)
+
     if obj.status not in ["ACTIVE"]:
         print "ERROR: LB not in an active status"
         exit(14)
@@ -105,27 +101,9 @@ def main():
     ERRORS = False
 
     # Compile a list of available flavours for use in argument parsing
-    # later on. The choices permitted will be made up of this list.
-    #    NOTE: Should revisit to make more dynamic and account for any
-    #          flavour updates
-    FLAVOUR_LIST = [
-                    "512MB Standard", 
-                    "1GB Standard",
-                    "2GB Standard",
-                    "4GB Standard",
-                    "8GB Standard",
-                    "15GB Standard",
-                    "30GB Standard",
-                    "1 GB Performance",
-                    "2 GB Performance",
-                    "4 GB Performance",
-                    "8 GB Performance",
-                    "15 GB Performance",
-                    "30 GB Performance",
-                    "60 GB Performance",
-                    "90 GB Performance",
-                    "120 GB Performance"
-                    ]
+    # later on. The choices permitted are taken from the cached catalog for
+    # the requested region (a default list is used if nothing is cached).
+    FLAVOUR_LIST = catalog.flavour_names(CONFIG_FILE, catalog.peek_region())
     
     # Compile a list of available LB algorithms (similar to above)
     ALGORITHM_LIST = [
@@ -160,8 +138,8 @@ def main():
                          " 'Debian 7')"), default="Debian 7 (Wheezy)")
     p.add_argument("-c", "--count", action="store", required=False,
                    metavar="[server count]", type=int,
-                   help="Number of servers to build (defaults to 2)",
-                   choices=xrange(1,11), default=2)
+                   help=("Number of servers to build (defaults to 2, at "
+                         "most the LB node limit)"), default=2)
     p.add_argument("-n", "--lb-name", action="store", required=False,
                    metavar="[lb name]", type=str,
                    help=("Preferred LB name (defaults to server prefix"
@@ -210,9 +188,6 @@ def main():
         print ("Base zone/domain in the format 'example.com' will not be "
                "accepted")
         exit(1)
-    # All is apparently well, define the zone/domain using the FQDN string
-    else:
-        zone_name = '.'.join(segments[-(len(segments)-1):])
     
     # If TTL has been provided, confirm that it is valid
     if args.ttl:
@@ -255,7 +230,7 @@ def main():
     try:
         creds_file = os.path.expanduser(CONFIG_FILE)
         pyrax.set_setting("identity_type", IDENTITY_TYPE)
-        pyrax.set_credential_file(creds_file, args.region)
+        tokencache.authenticate(creds_file, args.region)
     except e.AuthenticationFailed:
         print ("ERROR: Authentication failed. Please check and confirm "
                "that the API username, key, and region are in place and "
@@ -271,11 +246,21 @@ def main():
     cf = pyrax.cloudfiles
     clb = pyrax.cloud_loadbalancers
     dns = pyrax.cloud_dns
+
+    # Pace Cloud Servers requests according to the account's limits,
+    # queueing them rather than having builds fail as over limit
+    limiter = ratelimit.Scheduler.for_client(cs)
     
+    # Image, flavour and zone details are served from the local catalog
+    # cache
+    cat = catalog.Catalog(CONFIG_FILE, args.region, cs=cs, dns=dns)
+
     # Locate the image to build from (confirm it exists)
     try:
-        image = [i for i in cs.images.list() if args.image in i.name][0]
+        image = catalog.resolve_image(cat, cs, args.image)
     except:
+        image = None
+    if image is None:
         print ("ERROR: Image name provided was not found. Please check "
                "and try again")
         exit(7)
@@ -283,29 +268,35 @@ def main():
     # Grab the flavor ID from the RAM amount selected by the user.
     # The server create request requires the ID rather than RAM amount.
     try:
-        flavour = [f for f in cs.flavors.list() if args.flavour in f.name][0]
+        flavour = [f for f in cat.flavors() if args.flavour in f.name][0]
     except:
         print ("ERROR: Flavor name provided has not matched any entries. "
                "Please check and try again.")
         exit(8)
 
-    # Grab zone list
-    domains = zone_list(dns)
-
-    # No zones found, inform that one needs to be created and exit
-    if len(domains) == 0:
-        print "ERROR: You have no domains/zones at this time"
-        print "Please create one first then try again"
-        exit(9)
-
-    # Attempt to locate the zone extracted from FQDN string
+    # Locate the zone the FQDN belongs in (the longest zone name it ends
+    # with, so names in delegated sub-zones land in the sub-zone)
     try:
-        zone = [i for i in domains if zone_name in i.name][0]
+        zone = catalog.resolve_zone(cat, dns, args.fqdn)
     except:
-        print "ERROR: Zone '%s' not found" % (zone_name)
+        zone = None
+    if zone is None:
+        print "ERROR: No zone found for '%s'" % (args.fqdn)
         print "Please check/create and try again"
         exit(10)
     
+    # Confirm the account has room for the build, and that all of the
+    # servers can be placed behind the LB, before starting it
+    problems = fleet.preflight(limiter.absolute, args.count, flavour)
+    node_limit = fleet.lb_node_limit(clb)
+    if args.count < 1 or args.count > node_limit:
+        problems.append("server count must be between 1 and %d (LB node "
+                        "limit)" % (node_limit))
+    if problems:
+        for problem in problems:
+            print "ERROR: Build exceeds account limits -", problem
+        exit(15)
+
     # Determine the LB name from the args provided
     lbname = args.lb_name if args.lb_name else args.prefix + "lb"
 
@@ -318,58 +309,48 @@ def main():
     print ("\n-- Server build details\n\tPrefix: %s\n\tFlavour: %s"
            "\n\tCount: %d" % (args.prefix, args.flavour, args.count))
 
-    # Server list definition to be used in tracking build status/comletion
-    servers = []
+    # Server names to be built, numbered from the prefix provided
+    names = [args.prefix + str(count + 1) for count in xrange(args.count)]
 
-    # Iterate through the server count specified, sending the build request
-    # for each one in turn (concurrent builds)
-    for count in xrange(args.count):
-        # Issue the server creation request with the SSH key included
-        try:
-            srv = cs.servers.create(args.prefix + str(count + 1),
-                                    image.id, flavour.id, files=files)
-        # SSH key too large, fail
-        except exc.OverLimit:
-            print "ERROR: SSH public key exceeds permitted size"
-            exit(11)
-        
-        # Add server ID from the create request to the tracking list
-        servers.append(srv)
+    # Issue the server creation requests with the SSH key included (several
+    # at a time), tracking the builds with a single status poller
+    builds = engine.build_servers(cs, names, image, flavour, files=files)
 
     # Prepare a list for all active servers, since failed entries will
     # not be removed as we do not have health checks defined just yet
     srv = []
 
     # Check on the status of the server builds. Completed or error/unknown
-    # states are removed from the list until nothing remains.
-    while servers:
-        # Track the element position for easier/efficient removal
-        count = 0
-        for server in servers:
-            # Get the updated server details
-            server.get()
-            # Should it meet the necessary criteria, provide extended info
-            # and remove from the list
-            if server.status in ["ACTIVE", "ERROR", "UNKNOWN"]:
-                print ("\n-- Server details\n\tName: %s\n\tStatus: %s"
-                       "\n\tAdmin password: %s"
-                      % (server.name, server.status, server.adminPass))
+    # states are reported as soon as they are reached, with all pending
+    # builds refreshed by a single list request per check.
+    try:
+        for server in builds:
+            print ("\n-- Server details\n\tName: %s\n\tStatus: %s"
+                   "\n\tAdmin password: %s"
+                  % (server.name, server.status, server.adminPass))
+            # Failed build, state so to the client/user
+            if server.status not in ["ACTIVE"]:
+                ERRORS = True
+                print "WARN: Build process for %s failed" % (server.name)
+            # Otherwise append to the active list to be added to the LB
+            else:
                 print ("\tNetworks:\n\t\tPublic #1: %s\n\t\t"
                        "Public #2: %s\n\t\tPrivate: %s"
                        % (server.networks["public"][0],
                           server.networks["public"][1],
                           server.networks["private"][0]))
-                # Failed build, state so to the client/user
-                if server.status not in ["ACTIVE"]:
-                    ERRORS = True
-                    print "WARN: Build process for %s failed" % (server.name)
-                # Otherwise append to the active list to be added to the LB
-                else:
-                    srv.append(server)
-                del servers[count]
-            count += 1
-        # Reasonable wait period between checks
-        sleep(15)
+                srv.append(server)
+    # SSH key too large, fail (no build request is accepted)
+    except exc.OverLimit:
+        print "ERROR: SSH public key exceeds permitted size"
+        exit(11)
+
+    # Build requests failing part way through (e.g. quota reached)
+    for name, err in sorted(builds.failed.items()):
+        ERRORS = True
+        print "WARN: Build request for %s failed: %s" % (name, err)
+    if builds.skipped:
+        print "WARN: %d build request(s) not issued" % (len(builds.skipped))
 
     # Check if we have active servers, no point in proceeding if there
     # are none since at least a single instance is required to create
@@ -378,30 +359,22 @@ def main():
         print "ERROR: No servers in an active state, cannot create LB"
         exit(12)
     else:
-        # Otherwise, prepare and add all active nodes
-        nodes = []
-        for server in srv:
-            nodes.append(clb.Node(address=server.networks["private"][0],
-                                  port="80"))
-
-        # Define the VIP type based on argument provided by client/user
-        vip = clb.VirtualIP(type=args.lb_vip_type)
-        
-        # Create the LB
+        # Otherwise, create the LB with all active servers as nodes
         print "INFO: Creating the load balancer"
-        lb = clb.create(lbname, port=args.service_port, protocol="HTTP",
-                        nodes=nodes, virtual_ips=[vip])
+        lb = engine.create_lb(clb, lbname, srv, port=args.service_port,
+                              vip_type=args.lb_vip_type)
         
         # Wait for LB to settle down into active status
-        check_lb_status(lb)
+        check_lb_status(clb, lb)
         
         # Add a CONNECT health monitor for the nodes
         lb.add_health_monitor(type="CONNECT", delay=10, timeout=5,
                               attemptsBeforeDeactivation=3)
 
-        # Another check for status before we add the custom error page
-        lb.get()
-        check_lb_status(lb)
+        # Another check for status before we add the custom error page.
+        # The update has just been issued, so the LB is waited on even
+        # though the status last seen was active.
+        check_lb_status(clb, lb, wait_for_change=True)
         
         # Add a custom LB error page
         html = ("<html><head><title>Application error</title></head><body>"
@@ -427,18 +400,13 @@ def main():
             count += 1
             ip = public_ips[count]
         
-        # Attempt to add the new A record
-        a_rec = {"type": "A",
-                "name": args.fqdn,
-                "data": ip,
-                "ttl": ttl}
-
+        # Put the A record in place (nothing is sent if it is already
+        # there, and other records for the FQDN are left alone)
         try:
-            rec = zone.add_record(a_rec)
+            rec = dnsrecords.upsert(dns, zone, args.fqdn, ip, ttl=ttl)
             print ("\n-- Record details\n\tName: %s\n\tType: %s\n\tIP address: "
-                   "%s\n\tTTL: %s") % (rec[0].name, rec[0].type, rec[0].data,
-                   rec[0].ttl)
-        except e.DomainRecordAdditionFailed as err:
+                   "%s\n\tTTL: %s") % (rec.name, rec.type, rec.data, rec.ttl)
+        except e.PyraxException as err:
             print "ERROR: Record addition request failed:", err
             exit(13)
 
@@ -474,6 +442,11 @@ def main():
                     print ("INFO: Custom error page backed up to '%s'"
                             % (args.container + "/" + filename))
             
+        # Time spent waiting on rate limits, if any
+        if limiter.throttled:
+            print ("INFO: Requests throttled by rate limits for %.1fs"
+                   % (limiter.throttled))
+
         # All done
         exit_msg = "\nINFO: Build requests completed"
         if ERRORS:
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import sys
+from sys import exit
+
+import pyrax
+from pyrax import exceptions as e
+
+import ratelimit
+import regions
+import teardown
+import tokencache
+
+# Location of pyrax configuration file
+CONFIG_FILE = "~/.rackspace_cloud_credentials"
+
+# Identity type to be used (RAX)
+IDENTITY_TYPE = "rackspace"
+
+def main():
+    """
+    Challenge 13
+    -- Write an application that deletes everything in your cloud account
+       (clean up after the previous 12 challenge tasks, if you will). The
+       script should attempt to delete all Cloud Servers, custom Cloud
+       Server images, Cloud Files containers and objects, Cloud Database
+       instances, custom Cloud Networks and Cloud Block Storage volumes.
+    """
+    # Variable to determine if deletion errors were encountered
+    ERRORS = False
+
+    # Define the script parameters (all are optional)
+    parser = argparse.ArgumentParser(description=("Delete everything in a "
+                                                  "cloud account"))
+    parser.add_argument("-R", "--regions", action="store", required=False,
+                        metavar="[region list]", type=str,
+                        help=("Comma separated regions to clean up at the "
+                              "same time (defaults to all regions)"),
+                        default=",".join(regions.REGIONS))
+    parser.add_argument("-p", "--parallel", action="store", required=False,
+                        metavar="[deletions]", type=int,
+                        help=("Number of deletions of each kind of resource "
+                              "in progress at any one time (defaults to %d)"
+                              % (teardown.DEFAULT_PARALLELISM)),
+                        default=teardown.DEFAULT_PARALLELISM)
+    parser.add_argument("-d", "--dry-run", action="store_true",
+                        required=False,
+                        help=("Print what would be deleted (and in which "
+                              "order) without asking to delete anything"))
+    parser.add_argument("-y", "--yes", action="store_true", required=False,
+                        help=("Delete everything listed without asking for "
+                              "confirmation (by default the deletions are "
+                              "only made once confirmed, and only listed "
+                              "when there is no terminal to confirm them "
+                              "on)"))
+
+    # Parse arguments (validate user input)
+    args = parser.parse_args()
+    if args.dry_run and args.yes:
+        parser.error("--yes cannot be used with --dry-run")
+
+    # Regions to clean up (each listed once)
+    try:
+        plan = regions.region_plan(args.regions, 1)
+    except ValueError as err:
+        print "ERROR: %s" % (err)
+        exit(3)
+    if args.parallel < 1:
+        print "ERROR: At least one deletion at a time is required"
+        exit(4)
+
+    # Define the authentication credentials file location and request that
+    # pyrax makes use of it. If not found, let the client/user know about it.
+
+    # Use a credential file in the following format:
+    # [rackspace_cloud]
+    # username = myusername
+    # api_key = 01234567890abcdef
+    # region = LON
+
+    try:
+        creds_file = os.path.expanduser(CONFIG_FILE)
+        pyrax.set_setting("identity_type", IDENTITY_TYPE)
+        tokencache.authenticate(creds_file, plan[0][0])
+    except e.AuthenticationFailed:
+        print ("ERROR: Authentication failed. Please check and confirm "
+               "that the API username, key, and region are in place "
+               "and correct.")
+        exit(1)
+    except e.FileNotFound:
+        print "ERROR: Credentials file '%s' not found" % (creds_file)
+        exit(2)
+
+    # Connect to every service in each region (services not offered in a
+    # region are skipped), pacing Cloud Servers requests by the account's
+    # rate limits so mass deletions are queued rather than rejected
+    jobs = {}
+    for region, _ in plan:
+        clients = {
+            "compute": pyrax.connect_to_cloudservers(region=region),
+            "object_store": pyrax.connect_to_cloudfiles(region=region),
+            "database": pyrax.connect_to_cloud_databases(region=region),
+            "load_balancer": pyrax.connect_to_cloud_loadbalancers(
+                region=region),
+            "volume": pyrax.connect_to_cloud_blockstorage(region=region),
+            "network": pyrax.connect_to_cloud_networks(region=region)}
+        if clients["compute"]:
+            ratelimit.Scheduler.for_client(clients["compute"])
+        jobs[region] = (teardown.Teardown(region, clients, args.parallel),)
+
+    # Discover everything in all regions at the same time, printing each
+    # region's plan as soon as it is known
+    runs = regions.FanOut(teardown.plan_region, jobs)
+    for region, (what, item) in runs:
+        print "\n-- %s teardown plan" % (region)
+        for num, phase in enumerate(item, 1):
+            print "\tPhase %d:" % (num)
+            for kind, name in phase:
+                print "\t\tDelete %s '%s'" % (kind, name)
+            if not phase:
+                print "\t\tNothing to delete"
+
+    # Nothing is deleted unless asked for up front or confirmed once the
+    # plan has been seen
+    delete = args.yes
+    if not args.dry_run and not args.yes:
+        if sys.stdin.isatty():
+            answer = raw_input("\nDelete everything listed above in %s? "
+                               "[y/N] " % (", ".join(sorted(jobs))))
+            delete = answer.strip().lower() in ("y", "yes")
+        else:
+            print "\nINFO: Nothing deleted - use --yes to delete the above"
+    if delete:
+        print "WARN: Deleting everything in %s" % (", ".join(sorted(jobs)))
+
+        # Delete in all regions at the same time, reporting each deletion
+        # as soon as it completes (in whichever region)
+        plans = runs
+        runs = regions.FanOut(teardown.teardown_region, jobs)
+        runs.errors.update(plans.errors)
+        for region, (what, item) in runs:
+            kind, name, err = item
+            if err:
+                print ("WARN: [%s] Could not delete %s '%s': %s"
+                       % (region, kind, name, err))
+            else:
+                print "[%s] Deleted %s '%s'" % (region, kind, name)
+
+    # Per region wall time (and failure) summary
+    print "\n-- Region teardown times"
+    for region, _ in plan:
+        clean = jobs[region][0]
+        print ("\t%s: %.1fs (%d deleted, %d failed)"
+               % (region, runs.timings[region], clean.deleted,
+                  len(clean.errors)))
+        for kind, name, err in clean.errors:
+            ERRORS = True
+            if name == "(listing)":
+                print ("WARN: Could not list %s resources in %s: %s"
+                       % (kind, region, err))
+        if region in runs.errors:
+            ERRORS = True
+            print ("WARN: Teardown in %s failed: %s"
+                   % (region, runs.errors[region]))
+
+    # All done
+    exit_msg = "\nTeardown %s" % ("completed" if delete else "planned")
+    if ERRORS:
+        print "%s - with errors (see above for details)" % (exit_msg)
+    else:
+        print "%s" % (exit_msg)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,6 +24,9 @@ from time import sleep
 import pyrax
 from pyrax import exceptions as e
 
+import tokencache
+from poller import BuildWaiter, ImageWaiter
+
 # Set progress toolbar width (used with image and server creation progress)
 TOOLBAR_WIDTH = 50
 
@@ -70,7 +73,7 @@ def main():
     try:
         creds_file = os.path.expanduser(CONFIG_FILE)
         pyrax.set_setting("identity_type", IDENTITY_TYPE)
-        pyrax.set_credential_file(creds_file, args.region)
+        tokencache.authenticate(creds_file, args.region)
     except e.AuthenticationFailed:
         print ("ERROR: Authentication failed. Please check and confirm "
                "that the API username, key, and region are in place and "
@@ -106,12 +109,14 @@ def main():
 
     img = cs.images.get(img_id)
 
-    # Show image creation progressing while the status is 'SAVING'
-    while img.status in ["SAVING"]:
+    # Show image creation progressing while the status is 'SAVING'.
+    # Each check only requests images changed since the previous one.
+    waiter = ImageWaiter(cs, [img])
+    while waiter.pending:
         sys.stdout.write(".")
         sys.stdout.flush()
         sleep(30)
-        img = cs.images.get(img_id)
+        waiter.refresh()
     print
 
     # Something is not right with the image creation, bail out gracefully
@@ -126,11 +131,12 @@ def main():
     # as a template
     srv = cs.servers.create(dest_name, img.id, source.flavor["id"])
 
-    while srv.status in ["BUILD"]:
+    waiter = BuildWaiter(cs, [srv])
+    while waiter.pending:
         sys.stdout.write(".")
         sys.stdout.flush()
         sleep(15)
-        srv.get()  # Update server details
+        waiter.refresh()  # Update server details
     print
 
     # Server build has issues, show the status
@@ -17,14 +17,15 @@
 import argparse
 import os
 import sys
-from math import ceil
-from time import sleep
 
 import pyrax
 from pyrax import exceptions as e
 
-# Set progress toolbar width (used with image and server creation progress)
-TOOLBAR_WIDTH = 50
+import archive
+import progress
+import tokencache
+import uploader
+import uploadindex
 
 # Location of pyrax configuration file
 CONFIG_FILE = "~/.rackspace_cloud_credentials"
@@ -57,13 +58,56 @@ def main():
                          " (defaults to 'ORD'"),
                    choices=["ORD", "DFW", "LON", "IAD", "HKG", "SYD"],
                    default="ORD")
+    p.add_argument("-w", "--workers", action="store", required=False,
+                   metavar="[upload workers]", type=int,
+                   help=("Number of files uploaded at the same time "
+                         "(defaults to %d, or %d archives with --archive)"
+                         % (uploader.DEFAULT_WORKERS,
+                            archive.DEFAULT_WORKERS)))
+    p.add_argument("-m", "--segment-size", action="store", required=False,
+                   metavar="[segment size]", type=int,
+                   help=("Size (in MB) of the segments larger files are "
+                         "split into and uploaded in parallel (defaults "
+                         "to %d)" % (uploader.SEGMENT_SIZE / 1024 / 1024)),
+                   default=uploader.SEGMENT_SIZE / 1024 / 1024)
     p.add_argument("-f", "--force", action="store_true",
                    required=False, help=("Permit/force the upload to an "
                    "existing container"))
+    p.add_argument("-s", "--sync", action="store_true", required=False,
+                   help=("Upload only new or changed files to an existing "
+                         "container (implies the force flag)"))
+    p.add_argument("-d", "--delete", action="store_true", required=False,
+                   help=("Delete objects with no matching local file "
+                         "(sync only)"))
+    p.add_argument("-e", "--events", action="store", required=False,
+                   metavar="[event file]", type=str,
+                   help=("File progress events are appended to (one JSON "
+                         "object per line) for other tools to follow"))
+    p.add_argument("-v", "--verify", action="store_true", required=False,
+                   help=("Check the uploaded files against the container "
+                         "listing once the upload completes"))
+    p.add_argument("-a", "--archive", action="store_true", required=False,
+                   help=("Upload as tar archives extracted by Cloud Files, "
+                         "up to %d files per request (for trees of many "
+                         "small files)" % (archive.ARCHIVE_FILES)))
 
     # Parse arguments (validate user input)
     args = p.parse_args()
 
+    # Fewer archives than files are sent at once, each being much larger
+    if args.workers is None:
+        args.workers = (archive.DEFAULT_WORKERS if args.archive
+                        else uploader.DEFAULT_WORKERS)
+
+    # Stale objects are only known of when syncing
+    if args.delete and not args.sync:
+        p.error("--delete requires --sync")
+
+    # Segments can be no larger than the single object size limit
+    max_segment = uploader.MAX_OBJECT_SIZE / 1024 / 1024
+    if not 0 < args.segment_size <= max_segment:
+        p.error("segment size must be between 1 and %d MB" % (max_segment))
+
     # Determine if the upload directory exists
     if not os.path.isdir(args.directory):
         print ("ERROR: Specified directory (%s) does not exist, please check "
@@ -82,7 +126,7 @@ def main():
     try:
         creds_file = os.path.expanduser(CONFIG_FILE)
         pyrax.set_setting("identity_type", IDENTITY_TYPE)
-        pyrax.set_credential_file(creds_file, args.region)
+        tokencache.authenticate(creds_file, args.region)
     except e.AuthenticationFailed:
         print ("ERROR: Authentication failed. Please check and confirm "
                "that the API username, key, and region are in place "
@@ -116,40 +160,73 @@ def main():
     # determine if we can proceed (is the overwrite flag set)
     else:
         print "Container '%s' found" % (cont.name)
-        if args.force:
+        if args.sync:
+            print "Proceeding with sync against existing objects"
+        elif args.force:
             print "Proceeding as upload has been forced"
         else:
             print "Force flag not set, exiting..."
             sys.exit(5)
 
-    # Start the upload
+    # Start the upload (several files at a time)
     print "Beginning directory/folder upload"
-    (upload_key, total_bytes) = cf.upload_folder(args.directory, cont)
+    remote = uploader.container_listing(cf, cont) if args.sync else None
+    # Uploads are recorded in the local upload index, which also saves
+    # hashing files that have not been modified when syncing
+    index = uploadindex.UploadIndex()
+    # Progress is drawn as the workers report it, and optionally logged
+    listeners = [progress.Bar()]
+    if args.events:
+        listeners.append(progress.EventLog(open(args.events, "a")))
+    if args.archive:
+        up = archive.ArchiveUploader(cf, cont, workers=args.workers,
+                                     remote=remote, index=index,
+                                     listeners=listeners)
+    else:
+        up = uploader.Uploader(cf, cont, workers=args.workers, remote=remote,
+                               index=index,
+                               segment_size=args.segment_size * 1024 * 1024,
+                               listeners=listeners)
+    total_bytes = up.start(args.directory)
 
     # Inform the user of the total upload size
     print ("Total upload size: %d bytes (%.2f MB)"
            % (total_bytes, total_bytes / 1024.0 / 1024))
 
-    # Prepare progress toolbar
-    sys.stdout.write("[%s]" % (" " * TOOLBAR_WIDTH))
-    sys.stdout.flush()
-    # Return to start of line, after '['
-    sys.stdout.write("\b" * (TOOLBAR_WIDTH + 1))
-
-    # Print the upload progress (1 second interval)
-    uploaded = 0
-    while uploaded < total_bytes:
-        uploaded = cf.get_uploaded(upload_key)
-        progress = int(ceil((uploaded * 100.0) / total_bytes / 2))
-        sys.stdout.write("%s" % ("=" * progress))
-        sys.stdout.flush()
-        sys.stdout.write("\b" * (progress)) # Reset progress bar
-        sleep(1)
-    print
+    # Wait for the upload to finish (progress is drawn as it goes)
+    up.join()
+    index.close()
+
+    # Throughput summary, along with any files that failed to upload
+    for line in up.summary():
+        print line
+    for name, err in sorted(up.errors.items()):
+        print "WARN: Upload of '%s' failed: %s" % (name, err)
+
+    # Remove objects no longer present locally (sync only)
+    stale = up.stale()
+    if args.delete and stale:
+        deleted, errors = uploader.delete_objects(cf, cont, stale)
+        print "Deleted %d object(s) with no local file" % (deleted)
+        for err in errors:
+            print "WARN: Object deletion failed:", err
+
+    # Optionally confirm every file uploaded is in place (at its size)
+    if args.verify:
+        sizes = up.sizes()
+        missing, mismatched = uploader.verify_upload(cf, cont, sizes)
+        for name in missing:
+            print "WARN: Uploaded object '%s' is missing" % (name)
+        for name in mismatched:
+            print "WARN: Uploaded object '%s' has the wrong size" % (name)
+        if not missing and not mismatched:
+            print "Verified %d uploaded object(s)" % (len(sizes))
 
     # Upload completed, confirm/print object count
-    objs = cf.get_container_object_names(cont)
-    print "Number of objects uploaded: %d\nUpload complete" % (len(objs))
+    count, used = uploader.container_stats(cf, cont)
+    print ("Container now holds %d object(s), %.2f MB"
+           % (count, used / 1024.0 / 1024))
+    print "Upload complete"
 
 
 if __name__ == '__main__':
@@ -17,12 +17,18 @@
 import argparse
 import os
 import socket
+import sys
 from sys import exit
 from time import sleep
 
 import pyrax
 from pyrax import exceptions as e
 
+import catalog
+import dnsrecords
+import ratelimit
+import tokencache
+
 # Location of pyrax configuration file
 CONFIG_FILE = "~/.rackspace_cloud_credentials"
 
@@ -32,14 +38,8 @@ IDENTITY_TYPE = "rackspace"
 # Default TTL value
 DEFAULT_TTL = 300
 
-def zone_list(obj):
-    """
-    Return all zones under an account
-    """
-    # Get and return the zone list
-    doms = obj.list()
-    return doms
-
+# Most invalid record file rows listed before giving up on the file
+MAX_PROBLEMS = 20
 
 def is_int(val, limit):
     """
@@ -71,18 +71,61 @@ def is_valid_ipv4(address):
     return True
 
 
+def read_records(f, default_ttl):
+    """
+    Read A records from a file, one per line as a FQDN, IP address and
+    optional TTL (separated by spaces or commas, with '#' starting a
+    comment), returning the record dicts along with (line number, problem)
+    for every row that is not valid.  Repeated records are kept once.
+    """
+    records = []
+    problems = []
+    seen = set()
+    for num, line in enumerate(f, 1):
+        fields = line.split("#", 1)[0].replace(",", " ").split()
+        if not fields:
+            continue
+        if len(fields) not in [2, 3]:
+            problems.append((num, "Expected a FQDN, IP address and "
+                                  "optional TTL"))
+            continue
+        fqdn, ip = fields[:2]
+        ttl = default_ttl
+        if len(fields) == 3:
+            ttl = is_int(fields[2], DEFAULT_TTL)
+        if len(fqdn.split('.')) < 3:
+            problems.append((num, "FQDN '%s' is incorrectly formatted"
+                                  % (fqdn)))
+        elif not is_valid_ipv4(ip):
+            problems.append((num, "IP address '%s' is incorrectly "
+                                  "formatted" % (ip)))
+        elif not ttl:
+            problems.append((num, "TTL must be an integer greater or "
+                                  "equal to %d" % (DEFAULT_TTL)))
+        elif (fqdn.lower(), ip) not in seen:
+            seen.add((fqdn.lower(), ip))
+            records.append({"type": "A", "name": fqdn, "data": ip,
+                            "ttl": ttl})
+    return records, problems
+
+
 def main():
     """
     Challenge 4
     -- Write a script that uses Cloud DNS to create a new A record when
        passed a FQDN and IP address as arguments.
     """
+    # Variable to determine if record changes failed
+    ERRORS = False
+
     # Parse script parameters
     p = argparse.ArgumentParser(description=("Create an A record using FQDN "
                                              "and IP address parameters"))
     p.add_argument("fqdn", action="store", type=str, metavar="[fqdn]",
+                   nargs="?",
                    help="Fully qualified domain name for A record")
     p.add_argument("ip", action="store", type=str, metavar="[ip address]",
+                   nargs="?",
                    help="IP address to which A record will resolve to")
     p.add_argument("-r", "--region", action="store", required=False,
                    metavar="[region]", type=str,
@@ -94,12 +137,85 @@ def main():
                    required=False, type=int, metavar="[ttl value]",
                    help=("TTL for the new record (default %ds)"
                          % (DEFAULT_TTL)), default=DEFAULT_TTL)
+    p.add_argument("-f", "--file", action="store", required=False,
+                   metavar="[record file]", type=str,
+                   help=("Add the A records listed in a file instead, one "
+                         "per line as FQDN, IP address and optional TTL "
+                         "('-' reads them from stdin)"))
+    p.add_argument("-b", "--batch", action="store", required=False,
+                   metavar="[records]", type=int,
+                   help=("Number of records changed per request "
+                         "(defaults to %d)" % (dnsrecords.RECORD_BATCH)),
+                   default=dnsrecords.RECORD_BATCH)
+    p.add_argument("-s", "--sync", action="store", required=False,
+                   metavar="[zone state file]", type=str,
+                   help=("Make a zone hold exactly the records listed in a "
+                         "JSON state file instead (records not listed are "
+                         "deleted)"))
+    p.add_argument("-d", "--dry-run", action="store_true", required=False,
+                   help=("Print the record changes needed without making "
+                         "them"))
 
     # Parse arguments (validate user input)
     args = p.parse_args()
+    if args.file is None and args.sync is None and (args.fqdn is None or
+                                                     args.ip is None):
+        p.error("a FQDN and IP address are required unless a record or "
+                "state file is given")
+    if [args.file, args.sync, args.fqdn].count(None) != 2:
+        p.error("only one of a FQDN and IP address, a record file or a "
+                "state file can be given")
+    if args.batch < 1:
+        p.error("at least one record per request is required")
+
+    # If TTL has been provided, confirm that it is valid
+    if args.ttl:
+        ttl = is_int(args.ttl, DEFAULT_TTL)
+        if not ttl:
+            print ("ERROR: TTL must be an integer greater or equal to %d"
+                   % (DEFAULT_TTL))
+            exit(3)
+    else:
+        ttl = DEFAULT_TTL
+
+    # Read and validate every record in the file before any are added
+    if args.file is not None:
+        try:
+            if args.file == "-":
+                records, problems = read_records(sys.stdin, ttl)
+            else:
+                with open(args.file, "r") as f:
+                    records, problems = read_records(f, ttl)
+        except IOError as err:
+            print "ERROR: Record file could not be read: %s" % (err)
+            exit(9)
+        for num, problem in problems[:MAX_PROBLEMS]:
+            print "ERROR: Line %d: %s" % (num, problem)
+        if len(problems) > MAX_PROBLEMS:
+            print ("ERROR: ... and %d more invalid line(s)"
+                   % (len(problems) - MAX_PROBLEMS))
+        if problems:
+            print "Please check the record file and try again"
+            exit(10)
+        if not records:
+            print "ERROR: No records found in the record file"
+            exit(10)
+
+    # Read and validate the desired state of the zone to be synced
+    elif args.sync is not None:
+        try:
+            with open(args.sync, "r") as f:
+                zone_name, records = dnsrecords.read_state(f)
+        except IOError as err:
+            print "ERROR: State file could not be read: %s" % (err)
+            exit(9)
+        except ValueError as err:
+            print "ERROR: State file is incorrectly formatted: %s" % (err)
+            print "Please check the state file and try again"
+            exit(10)
 
     # Determine if IP address provided is formatted correctly
-    if not is_valid_ipv4(args.ip):
+    elif not is_valid_ipv4(args.ip):
         print ("ERROR: IP address provided is incorrectly formated, please "
                "check and try again")
         exit(1)
@@ -109,26 +225,12 @@ def main():
     #    NOTE: This can be improved since we're not checking whether or not
     #          the zone in question is a valid TLD or if the string only has
     #          valid (alphanumeric) characters
-    segments = args.fqdn.split('.')
-    if len(segments) < 3:
+    elif len(args.fqdn.split('.')) < 3:
         print ("ERROR: FQDN string is incorrectly formatted, please check "
                "and try again")
         print ("Base zone/domain in the format 'example.com' will not be "
                "accepted")
         exit(2)
-    # All is apparently well, define the zone/domain using the FQDN string
-    else:
-        zone_name = '.'.join(segments[-(len(segments)-1):])
-    
-    # If TTL has been provided, confirm that it is valid
-    if args.ttl:
-        ttl = is_int(args.ttl, DEFAULT_TTL)
-        if not ttl:
-            print ("ERROR: TTL must be an integer greater or equal to %d"
-                   % (DEFAULT_TTL))
-            exit(3)
-    else:
-        ttl = DEFAULT_TTL
 
     # Define the authentication credentials file location and request that
     # pyrax makes use of it. If not found, let the client/user know about it.
@@ -142,7 +244,7 @@ def main():
     try:
         creds_file = os.path.expanduser(CONFIG_FILE)
         pyrax.set_setting("identity_type", IDENTITY_TYPE)
-        pyrax.set_credential_file(creds_file, args.region)
+        tokencache.authenticate(creds_file, args.region)
     except e.AuthenticationFailed:
         print ("ERROR: Authentication failed. Please check and confirm "
                "that the API username, key, and region are in place and correct.")
@@ -155,38 +257,120 @@ def main():
     # This simplifies invocation later on (less typing)
     dns = pyrax.cloud_dns
 
-    # Grab zone list
-    domains = zone_list(dns)
+    # Zones are served from the local catalog cache
+    cat = catalog.Catalog(CONFIG_FILE, args.region, dns=dns)
+
+    # Record file: locate the zones of all the records at once
+    if args.file is not None:
+        names = set(r["name"] for r in records)
+        try:
+            zones = catalog.resolve_zones(cat, dns, names)
+        except Exception as err:
+            print "ERROR: Zones could not be listed: %s" % (err)
+            exit(7)
+        missing = sorted(names - set(zones))
+        if missing:
+            print ("ERROR: No zone found for %d name(s): %s"
+                   % (len(missing), ", ".join(missing[:MAX_PROBLEMS])))
+            print "Please check/create and try again"
+            exit(7)
+        targets = {}
+        for rec in records:
+            targets.setdefault(zones[rec["name"]], []).append(rec)
+        prune = False
 
-    # No zones found, inform that one needs to be created and exit
-    if len(domains) == 0:
-        print "ERROR: You have no domains/zones at this time"
-        print "Please create one first then try again"
-        exit(6)
+    # State file: the zone must exist under exactly the name given
+    elif args.sync is not None:
+        try:
+            zone = catalog.resolve_zone(cat, dns, zone_name)
+        except:
+            zone = None
+        if zone is None or zone.name.lower() != zone_name:
+            print "ERROR: Zone '%s' not found" % (zone_name)
+            print "Please check/create and try again"
+            exit(7)
+        targets = {zone: records}
+        prune = True
 
-    # Attempt to locate the zone extracted from FQDN string
-    try:
-        zone = [i for i in domains if zone_name in i.name][0]
-    except:
-        print "ERROR: Zone '%s' not found" % (zone_name)
-        print "Please check/create and try again"
-        exit(7)
-
-    # Attempt to add the new A record
-    a_rec = {"type": "A",
-            "name": args.fqdn,
-            "data": args.ip,
-            "ttl": ttl}
+    # Locate the zone the FQDN belongs in (the longest zone name it ends
+    # with, so names in delegated sub-zones land in the sub-zone)
+    else:
+        try:
+            zone = catalog.resolve_zone(cat, dns, args.fqdn)
+        except:
+            zone = None
+        if zone is None:
+            print "ERROR: No zone found for '%s'" % (args.fqdn)
+            print "Please check/create and try again"
+            exit(7)
+        a_rec = {"type": "A",
+                 "name": args.fqdn,
+                 "data": args.ip,
+                 "ttl": ttl}
+        targets = {zone: [a_rec]}
+        prune = False
 
-    try:
-        rec = zone.add_record(a_rec)
-        print "Successfully added"
-        print ("-- Record details\n\tName: %s\n\tType: %s\n\tIP address: "
-               "%s\n\tTTL: %s") % (rec[0].name, rec[0].type, rec[0].data,
-               rec[0].ttl)
-    except e.DomainRecordAdditionFailed as err:
-        print "ERROR: Record addition request failed:\nReason:", err
+    # Work out the changes each zone needs against its current records
+    # (served from the local cache while the zone is unchanged), so that
+    # records already in place are not sent again
+    batches = []
+    counts = {"create": 0, "update": 0, "delete": 0}
+    unchanged = 0
+    for zone, recs in targets.iteritems():
+        try:
+            current = dnsrecords.zone_records(dns, zone)
+        except e.PyraxException as err:
+            print ("ERROR: Records in zone '%s' could not be listed: %s"
+                   % (zone.name, err))
+            exit(11)
+        changes = dnsrecords.diff(zone, current, recs, prune)
+        unchanged += changes.unchanged
+        if args.dry_run:
+            for rec in changes.create:
+                print ("\tCreate %s %s -> %s (TTL %s)"
+                       % (rec["type"], rec["name"], rec["data"],
+                          rec["ttl"]))
+            for old, rec in changes.update:
+                print ("\tUpdate %s %s -> %s (TTL %s), was %s (TTL %s)"
+                       % (old.type, old.name, rec["data"], rec["ttl"],
+                          old.data, old.ttl))
+            for old in changes.delete:
+                print ("\tDelete %s %s -> %s"
+                       % (old.type, old.name, old.data))
+        for batch in dnsrecords.change_batches(zone, changes, args.batch):
+            counts[batch[1]] += len(batch[2])
+            batches.append(batch)
+
+    print ("INFO: %d record(s) to create, %d to update, %d to delete "
+           "(%d already in place)"
+           % (counts["create"], counts["update"], counts["delete"],
+              unchanged))
+    if args.dry_run:
+        print "Dry run - no records changed"
+        return
+
+    # Send only the changes, a batch per request with several requests (for
+    # one zone or many) in progress at the same time, paced according to
+    # the account's Cloud DNS rate limits
+    limiter = ratelimit.Scheduler.for_dns(dns) if batches else None
+    for zone, action, batch, result, err in dnsrecords.apply_changes(
+            dns, batches, limiter=limiter):
+        if err:
+            ERRORS = True
+            counts[action] -= len(batch)
+            print ("WARN: %d record(s) could not be %sd in '%s': %s"
+                   % (len(batch), action, zone.name, err))
+    if batches:
+        print ("\n-- Created %d, updated %d and deleted %d record(s)"
+               % (counts["create"], counts["update"], counts["delete"]))
+    if ERRORS:
+        print "Completed with errors (see above for details)"
         exit(8)
+    if args.fqdn is not None:
+        print "Record in place"
+        print ("-- Record details\n\tName: %s\n\tType: %s\n\tIP address: "
+               "%s\n\tTTL: %s") % (a_rec["name"], a_rec["type"],
+                                   a_rec["data"], a_rec["ttl"])
 
 
 if __name__ == '__main__':
@@ -22,6 +22,9 @@ from time import sleep
 import pyrax
 from pyrax import exceptions as e
 
+import catalog
+import tokencache
+
 # Location of pyrax configuration file
 CONFIG_FILE = "~/.rackspace_cloud_credentials"
 
@@ -35,13 +38,6 @@ IDENTITY_TYPE = "rackspace"
 #         parse the exception output/message for the current limit
 MAX_VOL_SIZE = 150
 
-# Available flavors
-#   NOTE: Can be handled better if we can grab the flavor list before the
-#         the arguments are parsed, this setting some choices dynamically.
-#         Since region is part of the argument list, we get into a bit of
-#         a pickle - region is an arg and needs to be parsed before we
-#         can authenticate and grab the flavor list :-/
-FLAVOUR_LIST = [512, 1024, 2048, 4096, 8192, 16384]
 
 
 def main():
@@ -51,6 +47,13 @@ def main():
        should contain at least one database, and the database should have at
        least one user that can connect to it.
     """
+    # Available flavors, taken from the cached catalog for the requested
+    # region (a default list of sizes is used if nothing is cached yet).
+    # The region is picked out of the arguments ahead of full parsing
+    # since the choices need to be in place before then.
+    FLAVOUR_LIST = catalog.db_flavour_sizes(CONFIG_FILE,
+                                            catalog.peek_region())
+
     # Parse script parameters
     p = argparse.ArgumentParser(description=("Create an Cloud DB instance "
                                              "along with a DB and management"
@@ -111,7 +114,7 @@ def main():
     try:
         creds_file = os.path.expanduser(CONFIG_FILE)
         pyrax.set_setting("identity_type", IDENTITY_TYPE)
-        pyrax.set_credential_file(creds_file, args.region)
+        tokencache.authenticate(creds_file, args.region)
     except e.AuthenticationFailed:
         print ("ERROR: Authentication failed. Please check and confirm "
                "that the API username, key, and region are in place and "
@@ -127,7 +130,8 @@ def main():
 
     # Determine which flavor was selected and grab the full details
     try:
-        flavor = [i for i in cdb.list_flavors() if args.memory == i.ram][0]
+        cat = catalog.Catalog(CONFIG_FILE, args.region, cdb=cdb)
+        flavor = [i for i in cat.db_flavors() if args.memory == i.ram][0]
     except:
         print ("ERROR: Flavor name provided has not matched any entries. "
                "Please check and try again.")
@@ -136,7 +140,7 @@ def main():
     # Attempt to create the instance
     try:
         print "INFO: Creating instance '%s'" % (args.instance)
-        instance = cdb.create(args.instance, flavor=flavor,
+        instance = cdb.create(args.instance, flavor=flavor.id,
                                 volume=args.volume)
     except:
         print "ERROR: Instance creation failed"
@@ -17,11 +17,17 @@
 import argparse
 import os
 from sys import exit
-from time import sleep
 
 import pyrax
 from pyrax import exceptions as e
 
+import catalog
+import engine
+import fleet
+import ratelimit
+import regions
+import tokencache
+
 # Location of pyrax configuration file
 CONFIG_FILE = "~/.rackspace_cloud_credentials"
 
@@ -38,27 +44,9 @@ def main():
     ERRORS = False
 
     # Compile a list of available flavours for use in argument parsing
-    # later on. The choices permitted will be made up of this list.
-    #    NOTE: Should revisit to make more dynamic and account for any
-    #          flavour updates
-    FLAVOUR_LIST = [
-                    "512MB Standard", 
-                    "1GB Standard",
-                    "2GB Standard",
-                    "4GB Standard",
-                    "8GB Standard",
-                    "15GB Standard",
-                    "30GB Standard",
-                    "1 GB Performance",
-                    "2 GB Performance",
-                    "4 GB Performance",
-                    "8 GB Performance",
-                    "15 GB Performance",
-                    "30 GB Performance",
-                    "60 GB Performance",
-                    "90 GB Performance",
-                    "120 GB Performance"
-                    ]
+    # later on. The choices permitted are taken from the cached catalog for
+    # the requested region (a default list is used if nothing is cached).
+    FLAVOUR_LIST = catalog.flavour_names(CONFIG_FILE, catalog.peek_region())
     
     # Compile a list of available LB algorithms (similar to above)
     ALGORITHM_LIST = [
@@ -87,8 +75,8 @@ def main():
                          " 'Debian 7')"), default="Debian 7 (Wheezy)")
     p.add_argument("-c", "--count", action="store", required=False,
                    metavar="[server count]", type=int,
-                   help="Number of servers to build (defaults to 2)",
-                   choices=xrange(1,11), default=2)
+                   help=("Number of servers to build (defaults to 2, at "
+                         "most the LB node limit)"), default=2)
     p.add_argument("-n", "--lb-name", action="store", required=False,
                    metavar="[lb name]", type=str,
                    help=("Preferred LB name (defaults to server prefix with "
@@ -112,9 +100,31 @@ def main():
                    choices=["ORD", "DFW", "LON", "IAD", "HKG", "SYD"],
                    default="ORD")
 
+    p.add_argument("-R", "--regions", action="store", required=False,
+                   metavar="[region list]", type=str,
+                   help=("Comma separated regions to build in at the same "
+                         "time, each with an optional server count (e.g. "
+                         "ORD:3,DFW,IAD:5). Overrides the region flag, "
+                         "count defaults to the count flag"))
+
     # Parse arguments (validate user input)
     args = p.parse_args()
 
+    # Determine the regions (and server count for each) to build in.
+    # Without a region list this is just the single region requested.
+    if args.regions:
+        try:
+            plan = regions.region_plan(args.regions, args.count)
+        except ValueError as err:
+            print "ERROR: Region list is incorrectly formatted -", err
+            exit(6)
+    else:
+        plan = [(args.region, args.count)]
+
+    if [c for r, c in plan if c < 1]:
+        print "ERROR: Server count must be at least 1"
+        exit(6)
+
     # Define the authentication credentials file location and request that pyrax
     # makes use of it. If not found, let the client/user know about it.
 
@@ -127,7 +137,7 @@ def main():
     try:
         creds_file = os.path.expanduser(CONFIG_FILE)
         pyrax.set_setting("identity_type", IDENTITY_TYPE)
-        pyrax.set_credential_file(creds_file, args.region)
+        tokencache.authenticate(creds_file, plan[0][0])
     except e.AuthenticationFailed:
         print ("ERROR: Authentication failed. Please check and confirm "
                "that the API username, key, and region are in place and "
@@ -137,117 +147,125 @@ def main():
         print "ERROR: Credentials file '%s' not found" % (creds_file)
         exit(2)
 
-    # Use a shorter Cloud Servers and LB class reference strings
-    # This simplifies invocation later on (less typing)
-    cs = pyrax.cloudservers
-    clb = pyrax.cloud_loadbalancers
-       
-    # Locate the image to build from (confirm it exists)
-    try:
-        image = [i for i in cs.images.list() if args.image in i.name][0]
-    except:
-        print ("ERROR: Image ID provided was not found. Please check "
-               "and try again")
-        exit(3)
-
-    # Grab the flavor ID from the RAM amount selected by the user.
-    # The server create request requires the ID rather than RAM amount.
-    try:
-        flavour = [f for f in cs.flavors.list() if args.flavour == f.name][0]
-    except:
-        print ("ERROR: Flavor name provided has not matched any entries. "
-               "Please check and try again.")
-        exit(4)
-    
     # Set the LB name from the args provided
     lbname = args.lb_name if args.lb_name else args.prefix + "lb"
 
+    # Resolve the image and flavour for every region ahead of the builds,
+    # each region having its own Cloud Servers and LB clients and catalog
+    jobs = {}
+    limiters = {}
+    for region, count in plan:
+        cs = pyrax.connect_to_cloudservers(region=region)
+
+        # Pace requests in the region according to the account's limits,
+        # queueing them rather than having builds fail as over limit
+        limiters[region] = ratelimit.Scheduler.for_client(cs)
+        clb = pyrax.connect_to_cloud_loadbalancers(region=region)
+
+        # Image and flavour details are served from the local catalog cache
+        cat = catalog.Catalog(CONFIG_FILE, region, cs=cs)
+
+        # Locate the image to build from (confirm it exists)
+        try:
+            image = catalog.resolve_image(cat, cs, args.image)
+        except:
+            image = None
+        if image is None:
+            print ("ERROR: Image ID provided was not found in %s. Please "
+                   "check and try again" % (region))
+            exit(3)
+
+        # Grab the flavor ID from the RAM amount selected by the user.
+        # The server create request requires the ID rather than RAM amount.
+        try:
+            flavour = [f for f in cat.flavors() if args.flavour == f.name][0]
+        except:
+            print ("ERROR: Flavor name provided has not matched any entries "
+                   "in %s. Please check and try again." % (region))
+            exit(4)
+
+        # Confirm the account has room for the build, and that all of the
+        # servers can be placed behind the LB, before starting it
+        problems = fleet.preflight(limiters[region].absolute, count, flavour)
+        node_limit = fleet.lb_node_limit(clb)
+        if count > node_limit:
+            problems.append("%d LB nodes requested, %d permitted"
+                            % (count, node_limit))
+        if problems:
+            for problem in problems:
+                print ("ERROR: Build in %s exceeds account limits - %s"
+                       % (region, problem))
+            exit(7)
+
+        names = [args.prefix + str(num + 1) for num in xrange(count)]
+        jobs[region] = (cs, clb, image, flavour, names, lbname,
+                        args.service_port, args.lb_vip_type, args.algorithm)
+
     print ("\nINFO: Cloud Server build request initiated\n"
            "\tTIP: You may wish to check available options by issuing "
            "the -h flag")
 
     # Print the image ID and name selected, as well as server count
-    print "\n-- Image details\n\tID: %s\n\tName: %s" % (image.id, image.name)
-    print ("\n-- Server build details\n\tFlavour: %s\n\tCount: %d"
-           % (args.flavour, args.count))
-
-    # Server list definition to be used in tracking build status/comletion
-    servers = []
-
-    # Iterate through the server count specified, sending the build request
-    # for each one in turn (concurrent builds)
-    for count in xrange(args.count):
-        # Issue the server creation request
-        srv = cs.servers.create(args.prefix + str(count + 1),
-                                   image.id, flavour.id)
-        # Add server ID from the create request to the tracking list
-        servers.append(srv)
-
-    # Prepare a list for all active servers, since failed entries will
-    # not be removed as we do not have health checks defined just yet
-    srv = []
-
-    # Check on the status of the server builds. Completed or error/unknown
-    # states are removed from the list until nothing remains.
-    while servers:
-        # Track the element position for easier/efficient removal
-        count = 0
-        for server in servers:
-            # Get the updated server details
-            server.get()
-            # Should it meet the necessary criteria, provide extended info
-            # and remove from the list
-            if server.status in ["ACTIVE", "ERROR", "UNKNOWN"]:
-                print ("\n-- Server details\n\tName: %s\n\tStatus: %s"
-                       "\n\tAdmin password: %s"
-                      % (server.name, server.status, server.adminPass))
+    for region, count in plan:
+        image = jobs[region][2]
+        print ("\n-- %s image details\n\tID: %s\n\tName: %s"
+               % (region, image.id, image.name))
+        print ("\n-- %s server build details\n\tFlavour: %s\n\tCount: %d"
+               % (region, args.flavour, count))
+
+    # Run the builds in all regions at the same time, reporting on each
+    # server (and LB) as soon as it is ready, in whichever region
+    lbs = 0
+    builds = regions.FanOut(engine.build_region_lb, jobs)
+    for region, (kind, item) in builds:
+        if kind == "server":
+            server = item
+            print ("\n-- Server details\n\tRegion: %s\n\tName: %s\n\t"
+                   "Status: %s\n\tAdmin password: %s"
+                  % (region, server.name, server.status, server.adminPass))
+            # Failed build, state so to the client/user
+            if server.status not in ["ACTIVE"]:
+                ERRORS = True
+                print "WARN: Build process for %s failed" % (server.name)
+            else:
                 print ("\tNetworks:\n\t\tPublic #1: %s\n\t\t"
                        "Public #2: %s\n\t\tPrivate: %s"
                        % (server.networks["public"][0],
                           server.networks["public"][1],
                           server.networks["private"][0]))
-                # Failed build, state so to the client/user
-                if server.status not in ["ACTIVE"]:
-                    ERRORS = True
-                    print "WARN: Build process for %s failed" % (server.name)
-                # Otherwise append to the active list to be added to the LB
-                else:
-                    srv.append(server)
-                del servers[count]
-            count += 1
-        # Reasonable wait period between checks
-        sleep(15)
-
-    # Check if we have active servers, no point in proceeding if there
-    # are none since at least a single instance is required to create
-    # an LB
-    if len(srv) == 0:
-        print "ERROR: No servers in an active state, cannot create LB"
+        # No active servers in the region, so no LB could be created there
+        elif item is None:
+            ERRORS = True
+            print ("ERROR: No servers in an active state in %s, cannot "
+                   "create LB" % (region))
+        else:
+            lb = item
+            lbs += 1
+            # Print LB details
+            public_ips = [vip.address for vip in lb.virtual_ips]
+            print ("\n-- LB details --\n\tRegion: %s\n\tName: %s\n\t"
+                   "Port: %s\n\tAlgorithm type: %s\n\tNode count: %s"
+                    % (region, lb.name, lb.port, lb.algorithm,
+                       len(lb.nodes)))
+            count = 1
+            for ip in public_ips:
+                print "\tIP address #%d: %s" % (count, ip)
+                count += 1
+
+    # Per region wall time (and failure) summary
+    print "\n-- Region build times"
+    for region, count in plan:
+        print ("\t%s: %.1fs (%.1fs throttled by rate limits)"
+               % (region, builds.timings[region], limiters[region].throttled))
+        if region in builds.errors:
+            ERRORS = True
+            print ("WARN: Build requests in %s failed: %s"
+                   % (region, builds.errors[region]))
+
+    # No LB created anywhere, the whole run has failed
+    if lbs == 0:
         exit(5)
-    else:
-        # Otherwise, prepare and add all active nodes
-        nodes = []
-        for server in srv:
-            nodes.append(clb.Node(address=server.networks["private"][0],
-                                  port="80"))
-
-        # Define the VIP type based on argument provided by client/user
-        vip = clb.VirtualIP(type=args.lb_vip_type)
-        
-        # Create the LB
-        lb = clb.create(lbname, port=args.service_port, protocol="HTTP",
-                        nodes=nodes, virtual_ips=[vip], algorithm=args.algorithm)
-
-        # Print LB details
-        public_ips = [vip.address for vip in lb.virtual_ips]
-        print ("\n-- LB details --\n\tName: %s\n\tPort: %s\n\t"
-               "Algorithm type: %s\n\tNode count: %s"
-                % (lb.name, lb.port, lb.algorithm, len(lb.nodes)))
-        count = 1
-        for ip in public_ips:
-            print "\tIP address #%d: %s" % (count, ip)
-            count += 1
-    
+
     # All done, complete with an overall status update
     exit_msg = "\nINFO: Build requests completed"
     if ERRORS:
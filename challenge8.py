@@ -17,14 +17,17 @@
 import argparse
 import os
 import sys
-from math import ceil
-from time import sleep
 
 import pyrax
 from pyrax import exceptions as e
 
-# Set progress toolbar width (used with image and server creation progress)
-TOOLBAR_WIDTH = 50
+import catalog
+import dnsrecords
+import progress
+import publish
+import tokencache
+import uploader
+import uploadindex
 
 # Location of pyrax configuration file
 CONFIG_FILE = "~/.rackspace_cloud_credentials"
@@ -38,15 +41,6 @@ DEFAULT_TTL = 300
 # Identity type to be used (RAX)
 IDENTITY_TYPE = "rackspace"
 
-def zone_list(obj):
-    """
-    Return all zones under an account
-    """
-    # Get and return the zone list
-    doms = obj.list()
-    return doms
-
-
 def main():
     """
     Challenge 8
@@ -88,13 +82,55 @@ def main():
                    help=(("CNAME record TTL (in seconds) for the CDN "
                           "URI (default %d seconds)") % (DEFAULT_TTL)),
                    default=DEFAULT_TTL)
+    p.add_argument("-w", "--workers", action="store", required=False,
+                   metavar="[upload workers]", type=int,
+                   help=("Number of files uploaded at the same time "
+                         "(defaults to %d)" % (uploader.DEFAULT_WORKERS)),
+                   default=uploader.DEFAULT_WORKERS)
+    p.add_argument("-m", "--segment-size", action="store", required=False,
+                   metavar="[segment size]", type=int,
+                   help=("Size (in MB) of the segments larger files are "
+                         "split into and uploaded in parallel (defaults "
+                         "to %d)" % (uploader.SEGMENT_SIZE / 1024 / 1024)),
+                   default=uploader.SEGMENT_SIZE / 1024 / 1024)
     p.add_argument("-f", "--force", action="store_true",
                    required=False,
                    help="Permit upload to an existing container")
+    p.add_argument("-s", "--sync", action="store_true", required=False,
+                   help=("Upload only new or changed files to an existing "
+                         "container (implies the force flag)"))
+    p.add_argument("-d", "--delete", action="store_true", required=False,
+                   help=("Delete objects with no matching local file "
+                         "(sync only)"))
+    p.add_argument("-e", "--events", action="store", required=False,
+                   metavar="[event file]", type=str,
+                   help=("File progress events are appended to (one JSON "
+                         "object per line) for other tools to follow"))
+    p.add_argument("-v", "--verify", action="store_true", required=False,
+                   help=("Check the uploaded files against the container "
+                         "listing once the upload completes"))
+    p.add_argument("-u", "--uncompressed", action="store_true",
+                   required=False,
+                   help=("Upload text assets (HTML, CSS, JS, SVG, ...) as "
+                         "they are rather than gzip compressed"))
+    p.add_argument("-p", "--fingerprint", action="store_true",
+                   required=False,
+                   help=("Rename assets referenced from pages and "
+                         "stylesheets after their content so they can be "
+                         "cached indefinitely (pages are cached briefly)"))
 
     # Parse arguments (validate user input)
     args = p.parse_args()
 
+    # Stale objects are only known of when syncing
+    if args.delete and not args.sync:
+        p.error("--delete requires --sync")
+
+    # Segments can be no larger than the single object size limit
+    max_segment = uploader.MAX_OBJECT_SIZE / 1024 / 1024
+    if not 0 < args.segment_size <= max_segment:
+        p.error("segment size must be between 1 and %d MB" % (max_segment))
+
     # Determine if the upload directory exists
     if not os.path.isdir(args.directory):
         print ("ERROR: Specified directory (%s) does not exist, please check "
@@ -123,9 +159,6 @@ def main():
         print ("Base zone/domain in the format 'example.com' will not be "
                "accepted")
         sys.exit(4)
-    # All is apparently well, define the zone/domain using the FQDN string
-    else:
-        zone_name = '.'.join(segments[-(len(segments)-1):])
 
     # Define the authentication credentials file location and request that
     # pyrax makes use of it. If not found, let the client/user know about it.
@@ -139,7 +172,7 @@ def main():
     try:
         creds_file = os.path.expanduser(CONFIG_FILE)
         pyrax.set_setting("identity_type", IDENTITY_TYPE)
-        pyrax.set_credential_file(creds_file, args.region)
+        tokencache.authenticate(creds_file, args.region)
     except e.AuthenticationFailed:
         print ("ERROR: Authentication failed. Please check and confirm "
                "that the API username, key, and region are in place "
@@ -154,20 +187,17 @@ def main():
     cf = pyrax.cloudfiles
     dns = pyrax.cloud_dns
 
-    # Grab zone list
-    domains = zone_list(dns)
+    # Zones are served from the local catalog cache
+    cat = catalog.Catalog(CONFIG_FILE, args.region, dns=dns)
 
-    # No zones found, inform that one needs to be created and exit
-    if len(domains) == 0:
-        print "ERROR: You have no domains/zones at this time"
-        print "Please create one first then try again"
-        sys.exit(7)
-
-    # Attempt to locate the zone extracted from FQDN string
+    # Locate the zone the FQDN belongs in (the longest zone name it ends
+    # with, so names in delegated sub-zones land in the sub-zone)
     try:
-        zone = [i for i in domains if zone_name in i.name][0]
+        zone = catalog.resolve_zone(cat, dns, args.fqdn)
     except:
-        print "ERROR: Zone '%s' not found" % (zone_name)
+        zone = None
+    if zone is None:
+        print "ERROR: No zone found for '%s'" % (args.fqdn)
         print "Please check/create and try again"
         sys.exit(8)
 
@@ -197,7 +227,9 @@ def main():
     else:
         print ("INFO: Container '%s' found with TTL set to %d"
                % (cont.name, cont.cdn_ttl))
-        if args.force:
+        if args.sync:
+            print "INFO: Proceeding with sync against existing objects"
+        elif args.force:
             print "INFO: Proceeding as force flag is set"
         else:
             print "INFO: Force flag not set, exiting..."
@@ -218,49 +250,84 @@ def main():
         f.write("Index page placeholder\n")
         f.close()
 
-    # Start the upload
+    # Prepare the site: fingerprint assets (rewriting references to them)
+    # and compress text assets (on a process pool) to be served compressed,
+    # keeping the original wherever compression does not help
+    site = publish.Site(args.directory)
+    if args.fingerprint:
+        site.fingerprint()
+        print "INFO: Fingerprinted %d asset(s)" % (site.fingerprinted)
+    if not args.uncompressed:
+        site.compress()
+        print ("INFO: Compressed %d text asset(s), saving %.2f MB"
+               % (site.compressed, site.saved / 1024.0 / 1024))
+
+    # Start the upload (several files at a time)
     print "INFO: Beginning directory/folder upload"
-    (upload_key, total_bytes) = cf.upload_folder(args.directory, cont)
+    remote = uploader.container_listing(cf, cont) if args.sync else None
+    # Uploads are recorded in the local upload index, which also saves
+    # hashing files that have not been modified when syncing
+    index = uploadindex.UploadIndex()
+    # Progress is drawn as the workers report it, and optionally logged
+    listeners = [progress.Bar()]
+    if args.events:
+        listeners.append(progress.EventLog(open(args.events, "a")))
+    up = uploader.Uploader(cf, cont, workers=args.workers, remote=remote,
+                           index=index,
+                           segment_size=args.segment_size * 1024 * 1024,
+                           listeners=listeners, names=site.names,
+                           sources=site.sources, headers=site.headers)
+    total_bytes = up.start(args.directory)
 
     # Inform the user of the total upload size
     print ("INFO: Total upload size: %d bytes (%.2f MB)"
            % (total_bytes, total_bytes / 1024.0 / 1024))
 
-    # Prepare progress toolbar
-    sys.stdout.write("[%s]" % (" " * TOOLBAR_WIDTH))
-    sys.stdout.flush()
-    # Return to start of line, after '['
-    sys.stdout.write("\b" * (TOOLBAR_WIDTH + 1))
-
-    # Print the upload progress (1 second interval)
-    uploaded = 0
-    while uploaded < total_bytes:
-        uploaded = cf.get_uploaded(upload_key)
-        progress = int(ceil((uploaded * 100.0) / total_bytes / 2))
-        sys.stdout.write("%s" % ("=" * progress))
-        sys.stdout.flush()
-        sys.stdout.write("\b" * (progress)) # Reset progress bar
-        sleep(1)
-    print
+    # Wait for the upload to finish (progress is drawn as it goes)
+    up.join()
+    index.close()
+
+    # Throughput summary, along with any files that failed to upload
+    for line in up.summary():
+        print "INFO: %s" % (line)
+    for name, err in sorted(up.errors.items()):
+        print "WARN: Upload of '%s' failed: %s" % (name, err)
+
+    # Remove objects no longer present locally (sync only)
+    stale = up.stale()
+    if args.delete and stale:
+        deleted, errors = uploader.delete_objects(cf, cont, stale)
+        print "INFO: Deleted %d object(s) with no local file" % (deleted)
+        for err in errors:
+            print "WARN: Object deletion failed:", err
+
+    # Optionally confirm every file uploaded is in place (at its size)
+    if args.verify:
+        sizes = up.sizes()
+        missing, mismatched = uploader.verify_upload(cf, cont, sizes)
+        for name in missing:
+            print "WARN: Uploaded object '%s' is missing" % (name)
+        for name in mismatched:
+            print "WARN: Uploaded object '%s' has the wrong size" % (name)
+        if not missing and not mismatched:
+            print "INFO: Verified %d uploaded object(s)" % (len(sizes))
 
     # Upload completed, print object count and CDN URIs
-    objs = cf.get_container_object_names(cont)
-    print "INFO: Number of objects uploaded: %d" % (len(objs))
-
-    # Attempt to create the new CNAME record
-    cname_rec = {"type": "CNAME",
-            "name": args.fqdn,
-            "data": cont.cdn_uri.replace("http://", ""),
-            "ttl": args.cname_ttl}
+    count, used = uploader.container_stats(cf, cont)
+    print ("INFO: Container now holds %d object(s), %.2f MB"
+           % (count, used / 1024.0 / 1024))
 
+    # Put the CNAME record in place (nothing is sent if it is already
+    # there, so publishing again is harmless)
     try:
-        rec = zone.add_record(cname_rec)
-        print "INFO: DNS record successfully added"
+        rec = dnsrecords.upsert(dns, zone, args.fqdn,
+                                cont.cdn_uri.replace("http://", ""),
+                                "CNAME", args.cname_ttl)
+        print "INFO: DNS record in place"
         print ("-- Record details\n\tName: %s\n\tType: %s\n\tIP address: "
-               "%s\n\tTTL: %s") % (rec[0].name, rec[0].type, rec[0].data,
-               rec[0].ttl)
+               "%s\n\tTTL: %s") % (rec.name, rec.type, rec.data, rec.ttl)
         print "INFO: All requests completed successfully"
-    except e.DomainRecordAdditionFailed as err:
+    except e.PyraxException as err:
         print "ERROR: Record addition request failed\nReason:", err
         sys.exit(12)
 
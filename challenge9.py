@@ -18,11 +18,15 @@ import argparse
 import os
 import socket
 from sys import exit
-from time import sleep
 
 import pyrax
 from pyrax import exceptions as e
 
+import catalog
+import dnsrecords
+import engine
+import tokencache
+
 # Location of pyrax configuration file
 CONFIG_FILE = "~/.rackspace_cloud_credentials"
 
@@ -32,15 +36,6 @@ IDENTITY_TYPE = "rackspace"
 # Default TTL value
 DEFAULT_TTL = 300
 
-def zone_list(obj):
-    """
-    Return all zones under an account
-    """
-    # Get and return the zone list
-    doms = obj.list()
-    return doms
-
-
 def is_int(val, limit):
     """
     Determine if value provided is an integer greater than or equal to limit
@@ -83,27 +78,9 @@ def main():
     ERRORS = False
 
     # Compile a list of available flavours for use in argument parsing
-    # later on. The choices permitted will be made up of this list.
-    #    NOTE: Should revisit to make more dynamic and account for any
-    #          flavour updates
-    FLAVOUR_LIST = [
-                    "512MB Standard", 
-                    "1GB Standard",
-                    "2GB Standard",
-                    "4GB Standard",
-                    "8GB Standard",
-                    "15GB Standard",
-                    "30GB Standard",
-                    "1 GB Performance",
-                    "2 GB Performance",
-                    "4 GB Performance",
-                    "8 GB Performance",
-                    "15 GB Performance",
-                    "30 GB Performance",
-                    "60 GB Performance",
-                    "90 GB Performance",
-                    "120 GB Performance"
-                    ]
+    # later on. The choices permitted are taken from the cached catalog for
+    # the requested region (a default list is used if nothing is cached).
+    FLAVOUR_LIST = catalog.flavour_names(CONFIG_FILE, catalog.peek_region())
 
     # Parse script parameters
     p = argparse.ArgumentParser(description=("Create a server using FQDN and "
@@ -146,9 +123,6 @@ def main():
         print ("Base zone/domain in the format 'example.com' will not be "
                "accepted")
         exit(1)
-    # All is apparently well, define the zone/domain using the FQDN string
-    else:
-        zone_name = '.'.join(segments[-(len(segments)-1):])
     
     # If TTL has been provided, confirm that it is valid
     if args.ttl:
@@ -172,7 +146,7 @@ def main():
     try:
         creds_file = os.path.expanduser(CONFIG_FILE)
         pyrax.set_setting("identity_type", IDENTITY_TYPE)
-        pyrax.set_credential_file(creds_file, args.region)
+        tokencache.authenticate(creds_file, args.region)
     except e.AuthenticationFailed:
         print ("ERROR: Authentication failed. Please check and confirm "
                "that the API username, key, and region are in place and correct.")
@@ -186,27 +160,27 @@ def main():
     cs = pyrax.cloudservers
     dns = pyrax.cloud_dns
 
-    # Grab zone list
-    domains = zone_list(dns)
-
-    # No zones found, inform that one needs to be created and exit
-    if len(domains) == 0:
-        print "ERROR: You have no domains/zones at this time"
-        print "Please create one first then try again"
-        exit(5)
+    # Image, flavour and zone details are served from the local catalog
+    # cache
+    cat = catalog.Catalog(CONFIG_FILE, args.region, cs=cs, dns=dns)
 
-    # Attempt to locate the zone extracted from FQDN string
+    # Locate the zone the FQDN belongs in (the longest zone name it ends
+    # with, so names in delegated sub-zones land in the sub-zone)
     try:
-        zone = [d for d in domains if zone_name in d.name][0]
+        zone = catalog.resolve_zone(cat, dns, args.fqdn)
     except:
-        print "ERROR: Zone '%s' not found" % (zone_name)
+        zone = None
+    if zone is None:
+        print "ERROR: No zone found for '%s'" % (args.fqdn)
         print "Please check/create and try again"
         exit(6)
 
     # Locate the image to build from (confirm it exists)
     try:
-        image = [i for i in cs.images.list() if args.image in i.name][0]
+        image = catalog.resolve_image(cat, cs, args.image)
     except:
+        image = None
+    if image is None:
         print ("ERROR: Image name provided was not found. Please check "
                "and try again")
         exit(7)
@@ -214,7 +188,7 @@ def main():
     # Grab the flavor ID from the flavour name selected by the user.
     # The server create request requires the relevant ID.
     try:
-        flavor = [f for f in cs.flavors.list() if args.flavour in f.name][0]
+        flavor = [f for f in cat.flavors() if args.flavour in f.name][0]
     except:
         print ("ERROR: Flavor name provided has not matched any entries. "
                "Please check and try again.")
@@ -227,11 +201,8 @@ def main():
 
     # Attempt to build the server and track progress
     print "\nBuilding server..."
-    srv = cs.servers.create(args.fqdn, image.id, flavor.id)
-
-    while srv.status in ["BUILD"]:
-        sleep(15)
-        srv.get()
+    for srv in engine.build_servers(cs, [args.fqdn], image, flavor):
+        pass
 
     # Server build has issues, show the status
     if srv.status not in ["ACTIVE"]:
@@ -257,20 +228,14 @@ def main():
         count += 1
         ip = srv.networks["public"][count]
 
-    # Define and attempt to add the new A record
-    a_rec = {"type": "A",
-            "name": args.fqdn,
-            "data": ip,
-            "ttl": ttl}
-
-    # Attempt to add the A record and we're done
+    # Put the A record in place (nothing is sent if it is already there,
+    # and other records for the FQDN are left alone) and we're done
     try:
-        rec = zone.add_record(a_rec)
+        rec = dnsrecords.upsert(dns, zone, args.fqdn, ip, ttl=ttl)
         print ("\n-- Record details\n\tName: %s\n\tType: %s\n\tIP address: "
-               "%s\n\tTTL: %s") % (rec[0].name, rec[0].type,
-                                    rec[0].data, rec[0].ttl)
+               "%s\n\tTTL: %s") % (rec.name, rec.type, rec.data, rec.ttl)
         print "INFO: All requests completed successfully"
-    except e.DomainRecordAdditionFailed as err:
+    except e.PyraxException as err:
         print "ERROR: Record creation failed:", err
         exit(9)
 
@@ -0,0 +1,435 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cPickle as pickle
+import json
+import os
+import tempfile
+from collections import deque, namedtuple
+from time import sleep
+
+from pyrax import exceptions as e
+
+import catalog
+import engine
+import poller
+
+# Default number of records changed in a zone by a single request
+RECORD_BATCH = 100
+
+# Default number of Cloud DNS jobs allowed in progress at any one time
+DEFAULT_WINDOW = 10
+
+# Default wait period (in seconds) between job status checks (record
+# changes complete in seconds, unlike server builds)
+JOB_INTERVAL = 2
+
+# TTL of records that do not name one
+DEFAULT_TTL = 300
+
+# Record sets are cached with the catalog cache, one file per zone
+RECORD_DIR = "records"
+
+# Record cache file layout version, bumped whenever the layout changes
+CACHE_VERSION = 1
+
+# Record types whose data is a host name (compared without regard to case
+# or a trailing dot)
+HOST_TYPES = ["CNAME", "MX", "NS", "PTR", "SRV"]
+
+# Error pyrax raises when each kind of change fails
+FAILURES = {"create": e.DomainRecordAdditionFailed,
+            "update": e.DomainRecordUpdateFailed,
+            "delete": e.DomainRecordDeletionFailed}
+
+# Compact record set entries, stored on disk as plain tuples
+Record = namedtuple("Record", "id type name data ttl priority")
+
+# Changes needed to bring a zone to the desired state: record dicts to
+# create, (Record, record dict) pairs to update, Records to delete and the
+# number of records already as desired
+Changes = namedtuple("Changes", "create update delete unchanged")
+
+
+def _key(rtype, name):
+    """
+    Return the record set key of a record (its type and name)
+    """
+    return rtype.upper(), name.lower().rstrip(".")
+
+
+def _data(rtype, data):
+    """
+    Return record data in a form that can be compared
+    """
+    if rtype.upper() in HOST_TYPES:
+        return data.lower().rstrip(".")
+    return data
+
+
+def _record(rec):
+    """
+    Return the Record for a record returned by the API (or a job's response)
+    """
+    get = rec.get if isinstance(rec, dict) else (
+        lambda attr: getattr(rec, attr, None))
+    return Record(get("id"), get("type"), get("name"), get("data"),
+                  get("ttl"), get("priority"))
+
+
+def cache_path(zone):
+    """
+    Return the record set cache file location for a zone
+    """
+    return os.path.join(os.path.expanduser(catalog.CACHE_DIR), RECORD_DIR,
+                        "%s.records" % (zone.id))
+
+
+def forget(zone):
+    """
+    Drop the cached record set of a zone (once changes have been made)
+    """
+    try:
+        os.unlink(cache_path(zone))
+    except OSError:
+        pass
+
+
+def _save(path, data):
+    """
+    Replace a record set cache file atomically
+    """
+    cache_dir = os.path.dirname(path)
+    try:
+        os.makedirs(cache_dir, 0700)
+    except OSError:
+        pass
+    fd, tmp = tempfile.mkstemp(dir=cache_dir)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def zone_records(dns, zone):
+    """
+    Return every record in a zone as Records.  The record set is served
+    from the local cache as long as the zone has not been updated since it
+    was cached (going by the zone's last updated time), and is otherwise
+    listed a page at a time and cached.
+    """
+    path = cache_path(zone)
+    updated = getattr(zone, "updated", None)
+    if updated:
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+            if (data.get("version") == CACHE_VERSION and
+                    data.get("updated") == updated):
+                return [Record(*r) for r in data["records"]]
+        except Exception:
+            pass
+    records = [_record(r) for r in dns.get_record_iterator(zone)]
+    if updated:
+        _save(path, {"version": CACHE_VERSION, "updated": updated,
+                     "records": [tuple(r) for r in records]})
+    return records
+
+
+def diff(zone, current, desired, prune=False):
+    """
+    Work out the changes that bring a zone's records (current, as Records)
+    to the desired records (record dicts).  A desired record already in the
+    zone with the same type, name and data is kept (updated if its TTL or
+    priority differ) and any other is created, leaving the rest of the zone
+    alone - records sharing a name (round robin A records, say) are never
+    overwritten or deleted.  Only when pruning does the zone end up holding
+    just the desired records (bar its own NS records, which are kept by
+    Cloud DNS): records of a desired type and name that are not wanted are
+    updated with the new data where possible and deleted otherwise, as are
+    all records of any other type and name.
+    """
+    existing = {}
+    for rec in current:
+        existing.setdefault(_key(rec.type, rec.name), []).append(rec)
+    wanted = {}
+    for rec in desired:
+        rec = dict(rec)
+        rec.setdefault("ttl", DEFAULT_TTL)
+        wanted.setdefault(_key(rec["type"], rec["name"]), []).append(rec)
+    changes = Changes([], [], [], 0)
+    unchanged = 0
+    for key, recs in wanted.iteritems():
+        have = list(existing.get(key, []))
+        left = []
+        for rec in recs:
+            same = [r for r in have
+                    if _data(r.type, r.data) == _data(rec["type"],
+                                                      rec["data"])]
+            if not same:
+                left.append(rec)
+                continue
+            have.remove(same[0])
+            if (same[0].ttl == rec["ttl"] and
+                    same[0].priority == rec.get("priority")):
+                unchanged += 1
+            else:
+                changes.update.append((same[0], rec))
+        if not prune:
+            changes.create.extend(left)
+            continue
+        for old, rec in zip(have, left):
+            changes.update.append((old, rec))
+        changes.create.extend(left[len(have):])
+        changes.delete.extend(have[len(left):])
+    if prune:
+        apex = _key("NS", zone.name)
+        for key, recs in existing.iteritems():
+            if key not in wanted and key != apex:
+                changes.delete.extend(recs)
+    return changes._replace(unchanged=unchanged)
+
+
+def chunks(records, size=RECORD_BATCH):
+    """
+    Split a list of records into lists of at most size records
+    """
+    return [records[i:i + size] for i in xrange(0, len(records), size)]
+
+
+def change_batches(zone, changes, size=RECORD_BATCH):
+    """
+    Return the (zone, action, records) batches making a zone's changes:
+    deletions first (so a record set can change type, e.g. from A to
+    CNAME), then updates and creations
+    """
+    batches = []
+    for chunk in chunks(changes.delete, size):
+        batches.append((zone, "delete", chunk))
+    updates = []
+    for old, rec in changes.update:
+        body = {"id": old.id, "name": old.name, "data": rec["data"],
+                "ttl": rec["ttl"]}
+        if rec.get("priority") is not None:
+            body["priority"] = rec["priority"]
+        updates.append(body)
+    for chunk in chunks(updates, size):
+        batches.append((zone, "update", chunk))
+    for chunk in chunks(changes.create, size):
+        batches.append((zone, "create", chunk))
+    return batches
+
+
+class Job(object):
+    """
+    A Cloud DNS asynchronous job making a batch of changes to a zone
+    """
+    def __init__(self, zone, action, records, info):
+        self.zone = zone
+        self.action = action
+        self.records = records
+        self._add_details(info)
+
+    def _add_details(self, info):
+        self._info = info
+        # The job ID is only given as part of the status URL
+        self.id = info["callbackUrl"].split("/status/")[-1]
+        self.status = info["status"]
+
+    def result(self):
+        """
+        Return the records in the job's response (once completed)
+        """
+        return [_record(r) for r in
+                (self._info.get("response") or {}).get("records", [])]
+
+    def error(self):
+        """
+        Return the failure of a job ending in error, as raised by pyrax
+        """
+        err = self._info.get("error", {})
+        return FAILURES[self.action]("%s: %s"
+                                     % (err.get("message", "Job failed"),
+                                        err.get("details", "")))
+
+    def outcome(self):
+        """
+        Return (zone, action, records, result, error) for a completed job
+        """
+        if self.status == "COMPLETED":
+            return self.zone, self.action, self.records, self.result(), None
+        return self.zone, self.action, self.records, [], self.error()
+
+
+class JobWaiter(poller.StatusWaiter):
+    """
+    Wait on Cloud DNS jobs (client is the Cloud DNS client).  There is no
+    'changes-since' listing for jobs, so each pending job is checked on
+    every pass - still from a single thread however many are in flight.
+    """
+    FINAL_STATES = ["COMPLETED", "ERROR"]
+
+    # Rate limit scheduler pacing the status checks (if any)
+    limiter = None
+
+    def list_changed(self, since):
+        changed = []
+        for job_id in list(self.pending):
+            uri = "/status/%s?showDetails=true" % (job_id)
+            if self.limiter:
+                self.limiter.throttle("GET", uri)
+            resp, info = self.client._manager.api.method_get(uri)
+            changed.append(Job(None, None, None, info))
+        return changed
+
+
+def submit(dns, zone, action, records, limiter=None):
+    """
+    Request a batch of changes to a zone, returning the job (or the
+    failure) without waiting for it to complete.  The request waits for
+    the rate limit scheduler provided, if any.
+    """
+    api = dns._manager.api
+    uri = "/domains/%s/records" % (zone.id)
+    if action == "delete":
+        uri = "%s?%s" % (uri, "&".join("id=%s" % (r.id) for r in records))
+    try:
+        if limiter:
+            limiter.throttle({"create": "POST", "update": "PUT",
+                              "delete": "DELETE"}[action], uri)
+        if action == "delete":
+            resp, info = api.method_delete(uri)
+        elif action == "update":
+            resp, info = api.method_put(uri, body={"records": records})
+        else:
+            resp, info = api.method_post(uri, body={"records": records})
+        return zone, action, records, Job(zone, action, records, info)
+    except Exception as err:
+        return zone, action, records, err
+
+
+def apply_changes(dns, batches, window=DEFAULT_WINDOW, interval=JOB_INTERVAL,
+                  limiter=None):
+    """
+    Make the (zone, action, records) batches of changes provided, yielding
+    (zone, action, records, result, error) for each as it completes
+    (result is the list of Records created, or error the failure).  Up to
+    window jobs are kept in progress at once, for one zone or several, all
+    followed by a single status poller; requests are paced by the rate
+    limit scheduler provided, if any.  Batches of the same kind for a zone
+    are made at the same time, but a zone's deletions, updates and
+    creations are each finished before the next kind starts (see
+    change_batches).  The cached record set of every zone changed is
+    dropped.
+    """
+    queued = {}
+    for batch in batches:
+        queued.setdefault(batch[0], deque()).append(batch)
+    for zone in queued:
+        forget(zone)
+    waiter = JobWaiter(dns, interval=interval)
+    waiter.limiter = limiter
+    # Kind of change and number of jobs in progress, by zone
+    running = {}
+    executor = engine.Executor(window)
+    try:
+        while queued or waiter.pending:
+            calls = []
+            for zone in list(queued):
+                left = queued[zone]
+                action, count = running.get(zone, (None, 0))
+                while (left and len(calls) + len(waiter.pending) < window and
+                       (not count or left[0][1] == action)):
+                    batch = left.popleft()
+                    action, count = batch[1], count + 1
+                    calls.append((dns,) + batch + (limiter,))
+                running[zone] = (action, count)
+                if not left:
+                    del queued[zone]
+            done = []
+            for zone, action, records, job in executor.run(submit, calls):
+                if isinstance(job, Exception):
+                    done.append((zone, action, records, [], job))
+                elif job.status in waiter.FINAL_STATES:
+                    done.append(job.outcome())
+                else:
+                    waiter.add(job)
+            if waiter.pending:
+                sleep(interval)
+                done.extend(job.outcome() for job in waiter.refresh())
+            for outcome in done:
+                action, count = running[outcome[0]]
+                running[outcome[0]] = (action, count - 1)
+                yield outcome
+    finally:
+        executor.close()
+
+
+def upsert(dns, zone, name, data, rtype="A", ttl=DEFAULT_TTL):
+    """
+    Make sure a zone holds a record, returning it as a Record.  Nothing is
+    sent if the zone already holds the record, a record with the same type,
+    name and data but another TTL is updated, and otherwise the record is
+    added - other records with the same name are left as they are.
+    """
+    rec = {"type": rtype, "name": name, "data": data, "ttl": ttl}
+    current = zone_records(dns, zone)
+    changes = diff(zone, current, [rec])
+    for old, new in changes.update:
+        current = [old._replace(data=new["data"], ttl=new["ttl"])]
+    for _, action, records, created, err in apply_changes(
+            dns, change_batches(zone, changes)):
+        if err:
+            raise err
+        current = created or current
+    return [r for r in current
+            if _key(r.type, r.name) == _key(rtype, name) and
+            _data(r.type, r.data) == _data(rtype, data)][0]
+
+
+def read_state(f):
+    """
+    Read the desired state of a zone from a JSON file, returning the zone
+    name and its record dicts.  The file holds an object naming the zone
+    and listing every record it should hold, e.g.
+
+        {"zone": "example.com",
+         "records": [{"name": "www.example.com", "type": "A",
+                      "data": "192.0.2.10", "ttl": 300}]}
+
+    Raises ValueError if the file is not laid out that way.
+    """
+    state = json.load(f)
+    if not isinstance(state, dict) or "zone" not in state:
+        raise ValueError("No zone named")
+    zone = state["zone"].lower().rstrip(".")
+    records = []
+    for num, rec in enumerate(state.get("records", []), 1):
+        if not isinstance(rec, dict):
+            raise ValueError("Record %d is not an object" % (num))
+        for field in ["name", "type", "data"]:
+            if not rec.get(field):
+                raise ValueError("Record %d has no %s" % (num, field))
+        name = rec["name"].lower().rstrip(".")
+        if name != zone and not name.endswith("." + zone):
+            raise ValueError("Record %d (%s) is not in %s"
+                             % (num, rec["name"], zone))
+        rec = dict((k, v) for k, v in rec.iteritems()
+                   if k in ["name", "type", "data", "ttl", "priority"])
+        rec["type"] = rec["type"].upper()
+        records.append(rec)
+    return zone, records
@@ -0,0 +1,243 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from multiprocessing.pool import ThreadPool
+from time import sleep
+
+from poller import POLL_INTERVAL, BuildWaiter, LBWaiter
+
+# Default number of API requests allowed in flight at any one time
+DEFAULT_WORKERS = 10
+
+# Default number of server build requests issued together
+DEFAULT_BATCH = 10
+
+# Default number of server builds allowed in progress at any one time
+DEFAULT_WINDOW = 100
+
+
+class Executor(object):
+    """
+    Bounded pool of worker threads for issuing blocking API requests.  Only
+    requests are run on the pool - waiting on builds is handled by a single
+    status poller however many builds are in flight, so the thread count
+    stays fixed regardless of the number of servers.
+    """
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.pool = ThreadPool(workers)
+
+    def run(self, fn, calls):
+        """
+        Run fn(*args) for every argument tuple provided, yielding results in
+        the order they complete.  The first failure is raised to the caller.
+        """
+        return self.pool.imap_unordered(lambda args: fn(*args), calls)
+
+    def close(self):
+        """
+        Stop accepting work and wait for the worker threads to finish
+        """
+        self.pool.close()
+        self.pool.join()
+
+
+def create_server(cs, name, image, flavour, files=None):
+    """
+    Issue a single server build request
+    """
+    return cs.servers.create(name, image.id, flavour.id, files=files)
+
+
+def wait_for_status(waiter):
+    """
+    Yield resources tracked by a status waiter as they reach a final state
+    """
+    for res in waiter:
+        yield res
+
+
+class Fleet(object):
+    """
+    Rolling window server build.  Build requests are issued a batch at a
+    time until the window of builds in progress is full, and topped up again
+    as builds complete, so any number of servers can be built without
+    holding more than the window open at once.  Servers are yielded as their
+    builds complete.
+
+    A build request failing before any has been accepted is raised to the
+    caller, as the request itself is at fault (e.g. an oversized personality
+    file).  Later failures (quota reached part way through) stop any further
+    requests being issued and are recorded in failed, by server name, with
+    the names never requested listed in skipped.
+    """
+    def __init__(self, cs, names, image, flavour, files=None,
+                 batch=DEFAULT_BATCH, window=DEFAULT_WINDOW, executor=None,
+                 interval=POLL_INTERVAL):
+        self.cs = cs
+        self.names = list(names)
+        self.image = image
+        self.flavour = flavour
+        self.files = files
+        self.batch = batch
+        self.window = max(window, batch)
+        self.executor = executor
+        self.interval = interval
+        self.failed = {}
+        self.skipped = []
+
+    def _create(self, name):
+        """
+        Issue a build request, returning the server or the failure
+        """
+        try:
+            return name, create_server(self.cs, name, self.image,
+                                       self.flavour, files=self.files)
+        except Exception as err:
+            return name, err
+
+    def _issue(self, executor, waiter, names):
+        """
+        Issue a batch of build requests and start tracking the servers
+        """
+        results = list(executor.run(self._create, [(n,) for n in names]))
+        failures = [(n, r) for n, r in results if isinstance(r, Exception)]
+        created = [r for n, r in results if not isinstance(r, Exception)]
+        if failures and not created and not waiter.resources:
+            raise failures[0][1]
+        for res in created:
+            waiter.add(res)
+        self.failed.update(failures)
+
+    def __iter__(self):
+        own = self.executor is None
+        executor = Executor(self.batch) if own else self.executor
+        waiter = BuildWaiter(self.cs, interval=self.interval)
+        queue = self.names[::-1]
+        try:
+            while queue or waiter.pending:
+                # Top the window up, a batch at a time
+                while queue and not self.failed:
+                    room = min(self.window - len(waiter.pending), self.batch)
+                    if room < 1:
+                        break
+                    batch = [queue.pop() for _ in xrange(min(room,
+                                                             len(queue)))]
+                    self._issue(executor, waiter, batch)
+                if self.failed:
+                    self.skipped.extend(queue[::-1])
+                    queue = []
+                if not waiter.pending:
+                    continue
+                for res in waiter.refresh():
+                    yield res
+                if waiter.pending:
+                    sleep(self.interval)
+        finally:
+            if own:
+                executor.close()
+
+
+def build_servers(cs, names, image, flavour, files=None, executor=None,
+                  batch=DEFAULT_BATCH, window=DEFAULT_WINDOW):
+    """
+    Build all server names provided, yielding each server as soon as its
+    build completes (see Fleet)
+    """
+    return Fleet(cs, names, image, flavour, files=files, batch=batch,
+                 window=window, executor=executor)
+
+
+def create_lb(clb, name, servers, port=80, vip_type="PUBLIC",
+              algorithm="RANDOM", wait=False):
+    """
+    Create an HTTP LB with the private addresses of the servers provided as
+    nodes, optionally waiting for it to become active
+    """
+    nodes = [clb.Node(address=server.networks["private"][0], port="80")
+             for server in servers]
+    vip = clb.VirtualIP(type=vip_type)
+    lb = clb.create(name, port=port, protocol="HTTP", nodes=nodes,
+                    virtual_ips=[vip], algorithm=algorithm)
+    if wait:
+        wait_for_lb(clb, lb)
+    return lb
+
+
+def wait_for_lb(clb, lb, wait_for_change=False):
+    """
+    Wait for an LB to settle down into a final state (updated in place).
+    Set wait_for_change when the LB has just been changed, so its status
+    is checked again even though the one recorded is final.
+    """
+    waiter = LBWaiter(clb, interval=10)
+    waiter.add(lb, wait_for_change)
+    for lb in wait_for_status(waiter):
+        pass
+    return lb
+
+
+class FleetError(Exception):
+    """
+    Raised once a fleet build completes if any build requests failed
+    """
+    def __init__(self, fleet):
+        name, err = sorted(fleet.failed.items())[0]
+        Exception.__init__(self, "%d build request(s) failed (%s: %s), %d "
+                           "not issued" % (len(fleet.failed), name, err,
+                                           len(fleet.skipped)))
+        self.failed = fleet.failed
+        self.skipped = fleet.skipped
+
+
+def build_region(region, cs, image, flavour, names, batch=DEFAULT_BATCH,
+                 window=DEFAULT_WINDOW, executor=None):
+    """
+    Build the named servers in a region, yielding each server as its build
+    completes.  FleetError is raised at the end if any requests failed.
+    """
+    fleet = build_servers(cs, names, image, flavour, executor=executor,
+                          batch=batch, window=window)
+    for server in fleet:
+        yield server
+    if fleet.failed:
+        raise FleetError(fleet)
+
+
+def build_region_lb(region, cs, clb, image, flavour, names, lbname,
+                    port=80, vip_type="PUBLIC", algorithm="RANDOM",
+                    batch=DEFAULT_BATCH, window=DEFAULT_WINDOW,
+                    executor=None):
+    """
+    Build the named servers in a region and place the active ones behind a
+    new LB, yielding ("server", server) as each build completes and finally
+    ("lb", lb) - the LB is None if no server builds succeeded.  FleetError
+    is raised at the end if any requests failed.
+    """
+    fleet = build_servers(cs, names, image, flavour, executor=executor,
+                          batch=batch, window=window)
+    active = []
+    for server in fleet:
+        if server.status in ["ACTIVE"]:
+            active.append(server)
+        yield "server", server
+
+    # At least a single active server is required to create an LB
+    if not active:
+        yield "lb", None
+    else:
+        yield "lb", create_lb(clb, lbname, active, port=port,
+                              vip_type=vip_type, algorithm=algorithm)
+
+    if fleet.failed:
+        raise FleetError(fleet)
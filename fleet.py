@@ -0,0 +1,77 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+
+# Numeric range within a server name pattern, e.g. web{001..500}
+RANGE_PATTERN = re.compile(r"\{(\d+)\.\.(\d+)\}")
+
+# Nodes permitted per LB when the account limit cannot be determined
+DEFAULT_NODE_LIMIT = 25
+
+
+def expand_names(pattern):
+    """
+    Expand a server name pattern into a list of names.  Each {first..last}
+    range is replaced by every number in it, zero padded to the width of
+    first if it has a leading zero (e.g. web{001..003} gives web001, web002
+    and web003).  Raises ValueError if a range runs backwards.
+    """
+    m = RANGE_PATTERN.search(pattern)
+    if not m:
+        return [pattern]
+    first, last = m.group(1), m.group(2)
+    if int(first) > int(last):
+        raise ValueError("Range '%s' runs backwards" % (m.group(0)))
+    width = len(first) if first.startswith("0") else 0
+    head = pattern[:m.start()]
+    tails = expand_names(pattern[m.end():])
+    return [head + str(num).zfill(width) + tail
+            for num in xrange(int(first), int(last) + 1) for tail in tails]
+
+
+def preflight(absolute, count, flavour):
+    """
+    Check a build of count servers of the flavour provided against the
+    account's absolute limits (as held by a rate limit scheduler),
+    returning a list of the limits it would exceed
+    """
+    checks = [("maxTotalInstances", "totalInstancesUsed", count,
+               "servers"),
+              ("maxTotalRAMSize", "totalRAMUsed", count * flavour.ram,
+               "MB of RAM")]
+    problems = []
+    for limit, used, wanted, what in checks:
+        # Limits not reported (or unlimited) are not checked
+        if absolute.get(limit, -1) < 0:
+            continue
+        free = absolute[limit] - absolute.get(used, 0)
+        if wanted > free:
+            problems.append("%d %s requested, %d available"
+                            % (wanted, what, max(free, 0)))
+    return problems
+
+
+def lb_node_limit(clb):
+    """
+    Return the number of nodes permitted per LB on the account
+    """
+    try:
+        resp, body = clb.method_get("/loadbalancers/absolutelimits")
+        for limit in body["absolute"]:
+            if limit["name"] == "NODE_LIMIT":
+                return limit["value"]
+    except Exception:
+        pass
+    return DEFAULT_NODE_LIMIT
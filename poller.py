@@ -0,0 +1,161 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from abc import ABCMeta, abstractmethod
+from datetime import datetime, timedelta
+from time import sleep
+
+# Default wait period (in seconds) between build status checks
+POLL_INTERVAL = 15
+
+# Allowance (in seconds) for clock drift between us and the API endpoints.
+# The 'changes-since' marker is wound back by this much on every check, so
+# a change is never missed (at worst it is seen twice, which is harmless).
+CLOCK_SKEW = 60
+
+# Timestamp format expected by the 'changes-since' filter
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class StatusWaiter(object):
+    """
+    Track a group of pending resources and hand back each one as soon as it
+    settles into a final state.  Every check is a single list request
+    filtered with 'changes-since', so only resources that have changed since
+    the previous check are transferred - an idle check returns an empty list.
+    Subclasses provide that list request (list_changed).
+    """
+    __metaclass__ = ABCMeta
+
+    # Resource states considered final
+    FINAL_STATES = []
+
+    def __init__(self, client, resources=None, interval=POLL_INTERVAL):
+        self.client = client
+        self.interval = interval
+        # Resource objects from the create requests, keyed by ID.  These are
+        # updated in place so details only returned on create (adminPass)
+        # are retained.
+        self.resources = {}
+        # IDs of resources yet to reach a final state
+        self.pending = set()
+        # Point in time from which changes are requested
+        self.since = datetime.utcnow() - timedelta(seconds=CLOCK_SKEW)
+        for res in resources or []:
+            self.add(res)
+
+    def add(self, res, wait_for_change=False):
+        """
+        Start tracking a resource, unless it is already known to be in a
+        final state.  The status is read from the details the resource came
+        with, as reading a missing attribute (a server fresh from a create
+        request has no status) has the client fetch the resource again.  A
+        resource just changed (its recorded status out of date) is tracked
+        whatever its status, when wait_for_change is set.
+        """
+        self.resources[res.id] = res
+        status = getattr(res, "_info", {}).get("status")
+        if wait_for_change or status not in self.FINAL_STATES:
+            self.pending.add(res.id)
+
+    @abstractmethod
+    def list_changed(self, since):
+        """
+        Return resources changed since the timestamp string provided
+        """
+
+    def refresh(self):
+        """
+        Update pending resources that have changed since the last check and
+        return those that have reached a final state
+        """
+        # Record the next marker before the request is issued so nothing
+        # that changes while the request is in flight is missed
+        now = datetime.utcnow() - timedelta(seconds=CLOCK_SKEW)
+        changed = self.list_changed(self.since.strftime(TIME_FORMAT))
+        self.since = now
+
+        done = []
+        for listed in changed:
+            if listed.id not in self.pending:
+                continue
+            res = self.resources[listed.id]
+            res._add_details(listed._info)
+            if res.status in self.FINAL_STATES:
+                self.pending.discard(res.id)
+                done.append(res)
+        return done
+
+    def __iter__(self):
+        """
+        Yield resources as they reach a final state, sleeping between checks
+        """
+        while self.pending:
+            for res in self.refresh():
+                yield res
+            if self.pending:
+                sleep(self.interval)
+
+
+class BuildWaiter(StatusWaiter):
+    """
+    Wait on Cloud Server builds (client is the Cloud Servers client)
+    """
+    # Deleted servers are included in a 'changes-since' listing, so there
+    # is no need to look for servers missing from the results
+    FINAL_STATES = ["ACTIVE", "ERROR", "UNKNOWN", "DELETED"]
+
+    def list_changed(self, since):
+        return self.client.servers.list(detailed=True,
+                                        search_opts={"changes-since": since})
+
+
+class ImageWaiter(StatusWaiter):
+    """
+    Wait on Cloud Server image creation (client is the Cloud Servers client)
+    """
+    FINAL_STATES = ["ACTIVE", "ERROR", "UNKNOWN", "DELETED"]
+
+    def list_changed(self, since):
+        # The image manager list call does not take filters, so go through
+        # the underlying list request directly
+        return self.client.images._list("/images/detail?changes-since=%s"
+                                        % (since), "images")
+
+
+class LBWaiter(StatusWaiter):
+    """
+    Wait on Cloud Load Balancer changes (client is the Cloud LB client)
+    """
+    FINAL_STATES = ["ACTIVE", "ERROR", "DELETED"]
+
+    def list_changed(self, since):
+        return self.client._manager._list("/loadbalancers?changes-since=%s"
+                                          % (since))
+
+
+class DeleteWaiter(BuildWaiter):
+    """
+    Wait on Cloud Server deletions (client is the Cloud Servers client)
+    """
+    # Servers are only settled once gone, whatever their state when the
+    # delete was requested (a server can pass through ERROR while going)
+    FINAL_STATES = ["DELETED"]
+
+    def add(self, res, wait_for_change=True):
+        """
+        Start tracking a server just asked to go - the status it came with
+        predates the delete request, so it is always tracked
+        """
+        StatusWaiter.add(self, res, True)
@@ -0,0 +1,203 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import sys
+import threading
+from collections import deque
+from time import sleep, time
+
+# Interval (in seconds) between progress updates
+UPDATE_INTERVAL = 0.5
+
+# Period (in seconds) the moving average rates are taken over
+RATE_WINDOW = 10
+
+# A busy worker that has sent nothing for this long (in seconds) is stalled
+STALL_AFTER = 30
+
+# Set progress bar width
+BAR_WIDTH = 50
+
+
+class Progress(object):
+    """
+    Transfer progress fed by callbacks from the workers doing the transfer
+    (bytes sent, files completed, worker busy or idle).  Every update
+    interval the current figures are handed to each listener as a dict:
+    bytes and files done, instantaneous and moving average rates, ETA and
+    any stalled workers.  A background timer keeps updates (and so stall
+    detection) going while nothing is being sent.  No API requests are
+    made.
+    """
+    def __init__(self, total, listeners, interval=UPDATE_INTERVAL):
+        self.total = total
+        self.listeners = listeners
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.done = 0
+        self.files = 0
+        self.started = time()
+        self.finished = False
+        # (time, bytes done, files done) at each update, for rates
+        self.samples = deque([(self.started, 0, 0)])
+        # Busy workers, by name, with the time they last sent anything
+        self.workers = {}
+        self.timer = threading.Thread(target=self._tick)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def sent(self, nbytes, worker=None):
+        """
+        Record bytes sent (negative when a failed attempt is taken back)
+        """
+        now = time()
+        with self.lock:
+            self.done += nbytes
+            if worker in self.workers:
+                self.workers[worker] = now
+        self._update(now)
+
+    def file_done(self):
+        """
+        Record a file as completed
+        """
+        with self.lock:
+            self.files += 1
+
+    def busy(self, worker):
+        """
+        Record a worker as having started on a file
+        """
+        with self.lock:
+            self.workers[worker] = time()
+
+    def idle(self, worker):
+        """
+        Record a worker as waiting for work
+        """
+        with self.lock:
+            self.workers.pop(worker, None)
+
+    def _stats(self, now, event):
+        """
+        Return the current figures, recording a sample for rates (lock held)
+        """
+        last_time, last_bytes, last_files = self.samples[-1]
+        self.samples.append((now, self.done, self.files))
+        while self.samples[0][0] < now - RATE_WINDOW:
+            self.samples.popleft()
+        first_time, first_bytes, first_files = self.samples[0]
+        span = now - first_time
+        step = now - last_time
+        rate = (self.done - last_bytes) / step if step else 0.0
+        avg_rate = (self.done - first_bytes) / span if span else 0.0
+        files_rate = (self.files - first_files) / span if span else 0.0
+        left = max(self.total - self.done, 0)
+        return {"event": event,
+                "time": now,
+                "elapsed": now - self.started,
+                "bytes": self.done,
+                "total": self.total,
+                "percent": (100.0 * self.done / self.total if self.total
+                            else 100.0),
+                "files": self.files,
+                "rate": rate,
+                "avg_rate": avg_rate,
+                "files_rate": files_rate,
+                "eta": left / avg_rate if avg_rate else None,
+                "stalled": sorted(w for w, t in self.workers.iteritems()
+                                  if now - t > STALL_AFTER)}
+
+    def _update(self, now, event="progress", force=False):
+        """
+        Hand the current figures to the listeners if an update is due
+        """
+        with self.lock:
+            if self.finished or (not force and
+                                 now - self.samples[-1][0] < self.interval):
+                return
+            stats = self._stats(now, event)
+            self.finished = event == "done"
+            for listener in self.listeners:
+                listener(stats)
+
+    def _tick(self):
+        """
+        Timer thread body, keeping updates going while nothing is sent
+        """
+        while not self.finished:
+            self._update(time())
+            sleep(self.interval)
+
+    def finish(self):
+        """
+        Hand the final figures to the listeners
+        """
+        self._update(time(), "done", force=True)
+
+
+def _mb(nbytes):
+    return nbytes / 1024.0 / 1024
+
+
+def _duration(secs):
+    """
+    Format a number of seconds as h:mm:ss
+    """
+    if secs is None:
+        return "-:--:--"
+    mins, secs = divmod(int(secs), 60)
+    hours, mins = divmod(mins, 60)
+    return "%d:%02d:%02d" % (hours, mins, secs)
+
+
+class Bar(object):
+    """
+    Progress listener redrawing a single line progress bar with the
+    current rates and ETA
+    """
+    def __init__(self, stream=sys.stdout, width=BAR_WIDTH):
+        self.stream = stream
+        self.width = width
+        # Length of the line last drawn, so a shorter one blanks it out
+        self.drawn = 0
+
+    def __call__(self, stats):
+        filled = int(self.width * min(stats["percent"], 100.0) / 100)
+        line = ("\r[%s%s] %3d%% %.2f MB/s (avg %.2f MB/s) %.1f files/s "
+                "ETA %s" % ("=" * filled, " " * (self.width - filled),
+                            stats["percent"], _mb(stats["rate"]),
+                            _mb(stats["avg_rate"]), stats["files_rate"],
+                            _duration(stats["eta"])))
+        if stats["stalled"]:
+            line += " - %d worker(s) stalled" % (len(stats["stalled"]))
+        self.stream.write(line.ljust(self.drawn))
+        self.drawn = len(line)
+        if stats["event"] == "done":
+            self.stream.write("\n")
+        self.stream.flush()
+
+
+class EventLog(object):
+    """
+    Progress listener writing each update as a JSON object on a line of
+    its own, for consumption by other tools
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __call__(self, stats):
+        self.stream.write(json.dumps(stats) + "\n")
+        self.stream.flush()
@@ -0,0 +1,279 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import hashlib
+import os
+import posixpath
+import re
+from multiprocessing import Pool
+
+import catalog
+import uploader
+
+# Staged copies of published files (rewritten or compressed) are kept under
+# the catalog cache, one directory per source folder
+STAGE_DIR = "publish"
+
+# Extensions of the text assets worth compressing
+COMPRESSIBLE = (".css", ".csv", ".htm", ".html", ".js", ".json", ".map",
+                ".svg", ".txt", ".xml")
+
+# Files smaller than this (in bytes) gain nothing from compression
+MIN_SIZE = 512
+
+# A compressed copy is only used if it saves at least this fraction of the
+# original size
+MIN_SAVING = 0.1
+
+# gzip compression level
+COMPRESS_LEVEL = 9
+
+# Extensions of pages, which keep their names (they are linked to from
+# elsewhere) and are only cached briefly
+PAGES = (".htm", ".html")
+
+# Extensions of stylesheets, whose references are rewritten too
+STYLESHEETS = (".css",)
+
+# Number of hex digits of the content MD5 put in fingerprinted names
+FINGERPRINT_LENGTH = 10
+
+# Cache-Control of fingerprinted assets (a changed asset gets a new name, so
+# they never need to be fetched again) and of pages
+ASSET_CACHE_CONTROL = "public, max-age=31536000"
+PAGE_CACHE_CONTROL = "public, max-age=300"
+
+# References to other files within pages and stylesheets
+PAGE_REFERENCE = re.compile(r"""\b(?:href|src)\s*=\s*["']?([^"'?#\s>]+)""",
+                            re.I)
+STYLE_REFERENCE = re.compile(r"""(?:url\(\s*|@import\s+)["']?([^"'?#\s)]+)""",
+                             re.I)
+
+
+def stage_dir(folder):
+    """
+    Return the staging directory for a source folder
+    """
+    key = hashlib.md5(os.path.abspath(folder)).hexdigest()
+    return os.path.join(os.path.expanduser(catalog.CACHE_DIR), STAGE_DIR, key)
+
+
+def fingerprinted(name, digest):
+    """
+    Return an object name with a content digest added before the
+    extension, e.g. css/site.css becomes css/site.0123456789.css
+    """
+    root, ext = posixpath.splitext(name)
+    return "%s.%s%s" % (root, digest[:FINGERPRINT_LENGTH], ext)
+
+
+def _resolve(ref, name):
+    """
+    Return the local name a reference made from a file refers to, or None
+    if it points elsewhere (another site, a data URI and so on)
+    """
+    if ":" in ref or ref.startswith("//"):
+        return None
+    if ref.startswith("/"):
+        return posixpath.normpath(ref.lstrip("/"))
+    return posixpath.normpath(posixpath.join(posixpath.dirname(name), ref))
+
+
+def _references(name, text):
+    """
+    Return the reference matches within a page or stylesheet
+    """
+    if name.lower().endswith(STYLESHEETS):
+        return list(STYLE_REFERENCE.finditer(text))
+    # Pages may hold inline styles as well as links
+    return (list(PAGE_REFERENCE.finditer(text)) +
+            list(STYLE_REFERENCE.finditer(text)))
+
+
+def _write(path, data):
+    """
+    Write a staged file, leaving it (and its modification time) alone if it
+    already holds the same data
+    """
+    if os.path.isfile(path):
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _compress(job):
+    """
+    Write a gzip compressed copy of a file (process pool task), returning
+    the object name, staged path and the original and compressed sizes.
+    The copy is only rewritten if the file has been modified since, and is
+    written reproducibly (no name or time stamp) so an unchanged file
+    always gives the same MD5 and is not uploaded again when syncing.
+    """
+    path, name, staged = job
+    st = os.stat(path)
+    if (not os.path.isfile(staged) or
+            os.path.getmtime(staged) != st.st_mtime):
+        try:
+            os.makedirs(os.path.dirname(staged))
+        except OSError:
+            pass
+        tmp = staged + ".tmp"
+        with open(path, "rb") as src, open(tmp, "wb") as dst:
+            gz = gzip.GzipFile(filename="", mode="wb", fileobj=dst,
+                               compresslevel=COMPRESS_LEVEL, mtime=0)
+            while True:
+                block = src.read(uploader.HASH_BLOCK_SIZE)
+                if not block:
+                    break
+                gz.write(block)
+            gz.close()
+        os.rename(tmp, staged)
+        os.utime(staged, (st.st_atime, st.st_mtime))
+    return name, staged, st.st_size, os.path.getsize(staged)
+
+
+class Site(object):
+    """
+    A static site prepared for publishing from a local folder.  Publishing
+    stages may give files other object names (names, by local name), have
+    staged copies uploaded in their place (sources) and add headers to be
+    sent with them (headers), the latter two by object name - all of which
+    are handed straight to an uploader.Uploader.  Staged copies are kept
+    between runs and only rewritten when their content changes, so syncing
+    an unchanged site uploads nothing.
+    """
+    def __init__(self, folder, ignore=None):
+        self.staging = stage_dir(folder)
+        # Every local file, by local name
+        self.files = dict((name, path) for path, name, size
+                          in uploader.walk_folder(folder, ignore))
+        self.names = {}
+        self.sources = {}
+        self.headers = {}
+        self.fingerprinted = 0
+        self.compressed = 0
+        self.saved = 0
+
+    def _header(self, obj, header, value):
+        self.headers.setdefault(obj, {})[header] = value
+
+    def fingerprint(self):
+        """
+        Rename the assets referenced from pages and stylesheets after their
+        content (see fingerprinted), rewrite the references to match, and
+        have fingerprinted assets cached for a year and pages for a few
+        minutes.  A stylesheet's name is taken from its rewritten content,
+        so a changed image renames the stylesheets referring to it too.
+        """
+        texts = dict((name, path) for name, path in self.files.iteritems()
+                     if name.lower().endswith(PAGES + STYLESHEETS))
+        referenced = set()
+        for name, path in texts.iteritems():
+            with open(path, "rb") as f:
+                for m in _references(name, f.read()):
+                    target = _resolve(m.group(1), name)
+                    if (target in self.files and
+                            not target.lower().endswith(PAGES)):
+                        referenced.add(target)
+        active = set()
+
+        def rename(name):
+            """
+            Return the object name of an asset, fingerprinting it (and
+            first anything it refers to) if not already done
+            """
+            if name in self.names or name in active:
+                return self.names.get(name, name)
+            active.add(name)
+            if name in texts:
+                digest = hashlib.md5(rewrite(name)).hexdigest()
+            else:
+                digest = uploader.file_md5(self.files[name])
+            active.discard(name)
+            self.names[name] = fingerprinted(name, digest)
+            self._header(self.names[name], "Cache-Control",
+                         ASSET_CACHE_CONTROL)
+            self.fingerprinted += 1
+            return self.names[name]
+
+        def rewrite(name):
+            """
+            Return the content of a page or stylesheet with its references
+            to fingerprinted assets rewritten
+            """
+            with open(self.files[name], "rb") as f:
+                text = f.read()
+            parts, pos = [], 0
+            for m in _references(name, text):
+                ref = m.group(1)
+                target = _resolve(ref, name)
+                if target not in referenced:
+                    continue
+                new = posixpath.basename(rename(target))
+                parts.append(text[pos:m.start(1)])
+                parts.append(ref[:ref.rfind("/") + 1] + new)
+                pos = m.end(1)
+            parts.append(text[pos:])
+            return "".join(parts)
+
+        for name in referenced:
+            rename(name)
+        for name in texts:
+            obj = self.names.get(name, name)
+            text = rewrite(name)
+            with open(self.files[name], "rb") as f:
+                changed = f.read() != text
+            if changed:
+                staged = os.path.join(self.staging, "rewritten", obj)
+                _write(staged, text)
+                self.sources[obj] = staged
+            if name.lower().endswith(PAGES):
+                self._header(obj, "Cache-Control", PAGE_CACHE_CONTROL)
+
+    def compress(self, processes=None):
+        """
+        Compress text assets on a process pool, to be uploaded with
+        Content-Encoding: gzip in place of the originals (or their
+        rewritten copies).  Files where compression does not save enough
+        to be worth it are left as they are.
+        """
+        jobs = []
+        for name, path in self.files.iteritems():
+            obj = self.names.get(name, name)
+            path = self.sources.get(obj, path)
+            if (obj.lower().endswith(COMPRESSIBLE) and
+                    os.path.getsize(path) >= MIN_SIZE):
+                jobs.append((path, obj,
+                             os.path.join(self.staging, "gzip", obj)))
+        if not jobs:
+            return
+        pool = Pool(processes)
+        try:
+            for obj, staged, size, csize in pool.imap_unordered(_compress,
+                                                                jobs, 16):
+                if csize <= size * (1 - MIN_SAVING):
+                    self.sources[obj] = staged
+                    self._header(obj, "Content-Encoding", "gzip")
+                    self.compressed += 1
+                    self.saved += size - csize
+        finally:
+            pool.close()
+            pool.join()
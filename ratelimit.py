@@ -0,0 +1,155 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import threading
+from collections import namedtuple
+from time import sleep, time
+
+from novaclient import exceptions as exc
+
+# Length (in seconds) of the rate limit units reported by the API
+UNITS = {"SECOND": 1, "MINUTE": 60, "HOUR": 3600, "DAY": 86400}
+
+# Number of times a request answered with an over limit (413) response is
+# queued again before the failure is passed on
+MAX_RETRIES = 5
+
+# A rate limit as reported by services other than Cloud Servers
+Limit = namedtuple("Limit", "verb regex value unit remain")
+
+
+class Bucket(object):
+    """
+    Token bucket for a single rate limit (one verb on one class of URLs).
+    The bucket holds at most the number of requests permitted per unit and
+    refills continuously, starting out with whatever the API reported as
+    remaining so requests made by earlier runs are accounted for.
+    """
+    def __init__(self, verb, regex, value, unit, remain=None):
+        self.verb = verb.upper()
+        self.regex = re.compile(regex)
+        self.capacity = float(value)
+        self.rate = self.capacity / UNITS.get(unit.upper(), 60)
+        self.tokens = self.capacity if remain is None else float(remain)
+        self.stamp = time()
+        self.lock = threading.Lock()
+
+    def matches(self, verb, url):
+        """
+        Determine whether a request is subject to this limit
+        """
+        return self.verb == verb.upper() and bool(self.regex.search(url))
+
+    def take(self):
+        """
+        Take a token from the bucket, returning 0 if one was available or
+        otherwise the time (in seconds) until one will be
+        """
+        with self.lock:
+            now = time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class Scheduler(object):
+    """
+    Paces requests to a service according to the account's rate limits,
+    queueing (sleeping) requests until the limit they fall under allows
+    them rather than letting them fail.  Requests rejected as over limit
+    anyway (other clients sharing the account) are retried after the delay
+    the API asks for.  The total time spent waiting is kept in throttled.
+    """
+    def __init__(self, rate=(), absolute=None):
+        self.buckets = [Bucket(r.verb, r.regex, r.value, r.unit, r.remain)
+                        for r in rate]
+        # Absolute (quota) limits by name, e.g. maxTotalInstances
+        self.absolute = absolute or {}
+        self.throttled = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def for_client(cls, cs):
+        """
+        Read the limits for the Cloud Servers client provided and pace all
+        further requests made through it
+        """
+        limits = cs.limits.get()
+        sched = cls(limits.rate,
+                    dict((l.name, l.value) for l in limits.absolute))
+        sched.install(cs.client)
+        return sched
+
+    @classmethod
+    def for_dns(cls, dns):
+        """
+        Read the limits for the Cloud DNS client provided.  Requests are
+        not wrapped, so callers pace them with throttle().
+        """
+        resp, body = dns.method_get("/limits")
+        rate = []
+        for entry in body.get("limits", {}).get("rate", []):
+            # Limits name their URLs with a regular expression or a glob
+            regex = entry.get("regex") or ".*".join(
+                re.escape(part) for part in entry["uri"].split("*"))
+            for limit in entry.get("limit", []):
+                rate.append(Limit(limit["verb"], regex, limit["value"],
+                                  limit["unit"], limit.get("remaining")))
+        return cls(rate, dict(body.get("limits", {}).get("absolute", {})))
+
+    def _wait(self, delay):
+        """
+        Sleep on behalf of a request, recording the time spent
+        """
+        with self.lock:
+            self.throttled += delay
+        sleep(delay)
+
+    def throttle(self, verb, url):
+        """
+        Block until every limit the request falls under has a token for it
+        """
+        for bucket in self.buckets:
+            if not bucket.matches(verb, url):
+                continue
+            delay = bucket.take()
+            while delay:
+                self._wait(delay)
+                delay = bucket.take()
+
+    def install(self, http):
+        """
+        Wrap the request method of a novaclient HTTP client so every
+        request made through it is paced
+        """
+        request = http._cs_request
+
+        def _cs_request(url, method, **kwargs):
+            for attempt in xrange(MAX_RETRIES + 1):
+                self.throttle(method, url)
+                try:
+                    return request(url, method, **kwargs)
+                except exc.OverLimit as err:
+                    # Quota (absolute limit) failures carry no retry delay
+                    # and will not succeed later, pass those straight on
+                    delay = getattr(err, "retry_after", 0)
+                    if not delay or attempt == MAX_RETRIES:
+                        raise
+                    self._wait(delay)
+        http._cs_request = _cs_request
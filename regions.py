@@ -0,0 +1,92 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from Queue import Empty, Queue
+from time import time
+
+# Regions available for resource creation
+REGIONS = ["ORD", "DFW", "LON", "IAD", "HKG", "SYD"]
+
+
+def region_plan(value, count):
+    """
+    Parse a comma separated list of regions, each optionally followed by
+    ':<count>' (e.g. 'ORD:100,DFW,IAD:50'), into a list of (region, count)
+    tuples.  Regions without an explicit count use the count provided.
+    Raises ValueError if the list is not correctly formatted.
+    """
+    plan = []
+    for entry in value.split(","):
+        region, _, num = entry.strip().upper().partition(":")
+        if region not in REGIONS:
+            raise ValueError("Unknown region '%s'" % (region))
+        if region in [r for r, n in plan]:
+            raise ValueError("Region '%s' listed more than once" % (region))
+        num = int(num) if num else count
+        if num < 1:
+            raise ValueError("Server count for '%s' must be at least 1"
+                             % (region))
+        plan.append((region, num))
+    return plan
+
+
+class FanOut(object):
+    """
+    Run one task per region concurrently, each in its own thread with its
+    own clients, and hand back whatever the tasks produce as soon as it is
+    produced.  Wall time (and any failure) is recorded per region.
+    """
+    def __init__(self, task, jobs):
+        # Task is a generator function called as task(region, *job)
+        self.task = task
+        # Region name to task arguments mapping
+        self.jobs = jobs
+        self.timings = {}
+        self.errors = {}
+        self.queue = Queue()
+
+    def _run(self, region, job):
+        """
+        Thread body, feeding task output (and completion) to the queue
+        """
+        start = time()
+        try:
+            for item in self.task(region, *job):
+                self.queue.put((region, item))
+        except Exception as err:
+            self.errors[region] = err
+        self.timings[region] = time() - start
+        self.queue.put((region, StopIteration))
+
+    def __iter__(self):
+        """
+        Yield (region, item) tuples in the order they are produced
+        """
+        for region, job in self.jobs.iteritems():
+            t = threading.Thread(target=self._run, args=(region, job))
+            t.daemon = True
+            t.start()
+
+        running = len(self.jobs)
+        while running:
+            # A timeout keeps the main thread responsive to Ctrl-C
+            try:
+                region, item = self.queue.get(True, 1)
+            except Empty:
+                continue
+            if item is StopIteration:
+                running -= 1
+            else:
+                yield region, item
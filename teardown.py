@@ -0,0 +1,316 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from Queue import Empty, Queue
+from time import sleep
+
+from pyrax import cloudnetworks
+from pyrax import exceptions as e
+
+import engine
+import poller
+import uploader
+
+# Default number of deletions of a single kind of resource in flight at once
+DEFAULT_PARALLELISM = 10
+
+# Number of times a delete refused while something still depends on the
+# resource (a volume still detaching, a network with ports left by servers
+# just deleted, a container not yet seen as empty) is attempted
+DELETE_ATTEMPTS = 10
+
+# Number of resources requested per page when listing servers, database
+# instances and load balancers (a single list request stops at the API's
+# own page size, leaving the rest undiscovered)
+PAGE_LIMIT = 100
+
+# HTTP status codes of refusals worth trying again: a conflict (something
+# still depends on the resource) or the account being over its limits
+RETRY_STATUSES = [409, 413]
+
+# Exceptions raised by pyrax in place of a refusal worth trying again
+RETRY_ERRORS = (e.NetworkInUse, e.VolumeNotAvailable)
+
+# Exceptions raised by pyrax in place of a 404 (the resource is gone)
+GONE_ERRORS = (e.NoSuchContainer, e.NetworkNotFound)
+
+# Kinds of resource in the order they are deleted.  Every kind in a phase is
+# deleted at the same time, and a phase only starts once the one before it
+# is done: load balancers (and with them their nodes) and volume attachments
+# go before the servers, volume snapshots before the volumes, and images
+# and networks once the servers are gone.
+PHASES = [["load balancer", "container", "database", "volume snapshot",
+           "volume attachment"],
+          ["server", "volume"],
+          ["image", "network"]]
+
+
+def _name(res):
+    """
+    Return the name of a resource (or its ID if it has none)
+    """
+    return getattr(res, "name", None) or res.id
+
+
+def _status(err):
+    """
+    Return the HTTP status code of a failed request (None if unknown) -
+    pyrax and novaclient record it as code, swiftclient as http_status
+    """
+    return getattr(err, "code", None) or getattr(err, "http_status", None)
+
+
+def _paged(lister):
+    """
+    Return a list call fetching every page of a marker/limit paginated
+    listing
+    """
+    def list_all():
+        found = []
+        marker = None
+        while True:
+            page = lister(limit=PAGE_LIMIT, marker=marker)
+            found.extend(page)
+            if len(page) < PAGE_LIMIT:
+                return found
+            marker = page[-1].id
+    return list_all
+
+
+class Teardown(object):
+    """
+    Delete everything in one region of an account: servers, custom images,
+    containers and objects, database instances, custom networks, volumes
+    (and their snapshots) and load balancers.  Resources are discovered
+    across the services at once, then deleted a phase at a time in
+    dependency order (see PHASES) with each kind of resource deleted on a
+    pool of its own.  Containers are emptied with bulk deletes, and server
+    deletions are followed with a single status poller.
+
+    Failures are recorded in errors (kind, name and exception) rather than
+    stopping the teardown, so as much as possible is removed in one run.
+    """
+    def __init__(self, region, clients, parallelism=DEFAULT_PARALLELISM,
+                 interval=poller.POLL_INTERVAL):
+        self.region = region
+        # Service clients for the region, by service - any service not
+        # offered in the region is left out (or None)
+        self.cs = clients.get("compute")
+        self.cf = clients.get("object_store")
+        self.cdb = clients.get("database")
+        self.clb = clients.get("load_balancer")
+        self.cbs = clients.get("volume")
+        self.cnw = clients.get("network")
+        self.parallelism = parallelism
+        self.interval = interval
+        # Resources to delete by kind, once discovered
+        self.resources = {}
+        self.deleted = 0
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def _listers(self):
+        """
+        Return the list call for each kind of resource whose service is
+        available in the region
+        """
+        listers = {}
+        if self.clb:
+            listers["load balancer"] = _paged(self.clb.list)
+        if self.cf:
+            listers["container"] = self.cf.get_all_containers
+        if self.cdb:
+            listers["database"] = _paged(self.cdb.list)
+        if self.cbs:
+            listers["volume snapshot"] = self.cbs.list_snapshots
+            listers["volume"] = self.cbs.list
+        if self.cs:
+            listers["server"] = _paged(self.cs.servers.list)
+            listers["image"] = self.cs.list_snapshots
+        if self.cnw:
+            listers["network"] = lambda: [
+                n for n in self.cnw.list()
+                if n.id not in cloudnetworks.PSEUDO_NETWORKS]
+        return listers
+
+    def _discover_kind(self, kind, lister):
+        try:
+            return kind, lister(), None
+        except Exception as err:
+            return kind, [], err
+
+    def discover(self):
+        """
+        List the resources of every kind at the same time, returning them
+        by kind
+        """
+        listers = self._listers()
+        executor = engine.Executor(len(listers) or 1)
+        try:
+            for kind, found, err in executor.run(self._discover_kind,
+                                                 listers.items()):
+                self.resources[kind] = list(found)
+                if err:
+                    self.errors.append((kind, "(listing)", err))
+        finally:
+            executor.close()
+        self.resources["volume attachment"] = [
+            v for v in self.resources.get("volume", []) if v.attachments]
+        return self.resources
+
+    def plan(self):
+        """
+        Return the deletions to be made as a list of phases, each a list of
+        (kind, name) tuples
+        """
+        return [[(kind, _name(res)) for kind in phase
+                 for res in self.resources.get(kind, [])]
+                for phase in PHASES]
+
+    def _retrying(self, fn, *args):
+        """
+        Call fn, trying again while something it depends on is going away
+        (or the API is refusing or failing requests for the moment), and
+        return False if the resource was already gone, True otherwise.  Any
+        other failure is raised straight away.
+        """
+        for attempt in xrange(DELETE_ATTEMPTS):
+            try:
+                fn(*args)
+                return True
+            except Exception as err:
+                status = _status(err)
+                if status == 404 or isinstance(err, GONE_ERRORS):
+                    return False
+                retry = (status in RETRY_STATUSES or (status or 0) >= 500 or
+                         isinstance(err, RETRY_ERRORS))
+                if not retry or attempt == DELETE_ATTEMPTS - 1:
+                    raise
+                sleep(self.interval)
+
+    def _delete_container(self, cont):
+        """
+        Empty a container with bulk deletes (a listing page at a time) and
+        delete it
+        """
+        names = []
+        for obj in uploader.iter_listing(self.cf.connection, cont.name):
+            names.append(obj["name"])
+            if len(names) == uploader.BULK_DELETE_LIMIT:
+                self._bulk_delete(cont, names)
+                names = []
+        if names:
+            self._bulk_delete(cont, names)
+        self.cf.delete_container(cont)
+
+    def _bulk_delete(self, cont, names):
+        deleted, errors = uploader.delete_objects(self.cf, cont, names)
+        if errors:
+            raise Exception("Bulk delete failed: %s" % (errors))
+
+    def _delete(self, kind, res):
+        """
+        Delete (or detach) a single resource, returning (kind, resource,
+        error, requested) - requested is set when a deletion was accepted
+        rather than the resource found already gone
+        """
+        try:
+            if kind == "container":
+                # Objects written while the container is emptied leave it
+                # refusing the delete, so it is emptied again
+                requested = self._retrying(self._delete_container, res)
+            elif kind == "volume attachment":
+                requested = self._retrying(res.detach)
+            else:
+                requested = self._retrying(res.delete)
+        except Exception as err:
+            return kind, res, err, False
+        return kind, res, None, requested
+
+    def _run_kind(self, kind, results):
+        """
+        Delete every resource of a kind on a pool of its own, handing the
+        outcomes to the results queue (servers once they are gone)
+        """
+        resources = self.resources.get(kind, [])
+        executor = engine.Executor(self.parallelism)
+        # The waiter is created before the first delete is issued, so its
+        # changes-since marker predates every deletion (a server deleted
+        # before the marker would never be listed, and waited on forever)
+        waiter = None
+        if kind == "server":
+            waiter = poller.DeleteWaiter(self.cs, interval=self.interval)
+        try:
+            for kind, res, err, accepted in executor.run(
+                    self._delete, [(kind, r) for r in resources]):
+                if waiter and accepted:
+                    waiter.add(res)
+                else:
+                    results.put((kind, _name(res), err))
+        finally:
+            executor.close()
+        if waiter:
+            for server in waiter:
+                results.put((kind, _name(server), None))
+        results.put(None)
+
+    def run(self):
+        """
+        Delete everything discovered, a phase at a time, yielding
+        (kind, name, error) for each deletion as it completes (error is
+        None if it succeeded)
+        """
+        for phase in PHASES:
+            results = Queue()
+            kinds = [k for k in phase if self.resources.get(k)]
+            for kind in kinds:
+                t = threading.Thread(target=self._run_kind,
+                                     args=(kind, results))
+                t.daemon = True
+                t.start()
+            running = len(kinds)
+            while running:
+                # A timeout keeps the main thread responsive to Ctrl-C
+                try:
+                    outcome = results.get(True, 1)
+                except Empty:
+                    continue
+                if outcome is None:
+                    running -= 1
+                    continue
+                with self.lock:
+                    if outcome[2] is None:
+                        self.deleted += 1
+                    else:
+                        self.errors.append(outcome)
+                yield outcome
+
+
+def plan_region(region, teardown):
+    """
+    Region task (see regions.FanOut) discovering everything in a region and
+    yielding ("plan", phases)
+    """
+    teardown.discover()
+    yield "plan", teardown.plan()
+
+
+def teardown_region(region, teardown):
+    """
+    Region task (see regions.FanOut) deleting everything discovered in a
+    region and yielding ("deleted", (kind, name, error)) for each deletion
+    """
+    for outcome in teardown.run():
+        yield "deleted", outcome
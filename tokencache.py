@@ -0,0 +1,145 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cPickle as pickle
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pyrax
+from pyrax import exceptions as e
+
+# Suffix appended to the credentials file name for the token cache (and
+# its lock file), keeping the cache alongside the credentials it is for
+TOKEN_CACHE_SUFFIX = ".tokens"
+
+# Tokens this close (in seconds) to expiry are treated as expired, so a
+# run is not left holding a token that lapses part way through
+EXPIRY_MARGIN = 300
+
+# Identity attributes saved to (and restored from) the cache
+IDENTITY_ATTRS = ["token", "expires", "tenant_id", "tenant_name", "services",
+                  "regions", "user", "username", "_default_region",
+                  "_creds_style"]
+
+
+@contextmanager
+def _locked(path):
+    """
+    Hold an exclusive lock on the cache while it is read and updated.  This
+    also means simultaneous runs with an expired token wait for the first
+    one to re-authenticate rather than all doing so at once.
+    """
+    fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+def _load(path):
+    """
+    Read the token cache, returning an empty one if missing or unusable
+    """
+    try:
+        with open(path, "rb") as f:
+            return pickle.load(f)
+    except Exception:
+        return {}
+
+
+def _save(path, key, state):
+    """
+    Store identity state for a user/region in the cache (lock must be held)
+    """
+    tokens = _load(path)
+    tokens[key] = state
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(tokens, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def _snapshot(ident):
+    """
+    Return the cacheable state of an authenticated identity
+    """
+    return dict((attr, getattr(ident, attr, None)) for attr in IDENTITY_ATTRS)
+
+
+def _valid(state):
+    """
+    Determine whether cached identity state holds an unexpired token (pyrax
+    records the expiry time in UTC)
+    """
+    margin = timedelta(seconds=EXPIRY_MARGIN)
+    return bool(state and state.get("token") and
+                state.get("expires") > datetime.utcnow() + margin)
+
+
+def _record_reauth(ident, path, key):
+    """
+    Wrap the identity authenticate() call so re-authentication triggered
+    later on (an API request answered with a 401) also refreshes the cache
+    """
+    authenticate = ident.authenticate
+
+    def _authenticate():
+        with _locked(path):
+            authenticate()
+            _save(path, key, _snapshot(ident))
+    ident.authenticate = _authenticate
+
+
+def authenticate(creds_file, region):
+    """
+    Authenticate using the credentials file provided and connect to all
+    services in the region.  The token and service catalog are reused from
+    the cache kept alongside the credentials file while the token is valid,
+    avoiding the identity round trip entirely.  Raises the same exceptions
+    as pyrax.set_credential_file().
+    """
+    # Read in the credentials without authenticating
+    pyrax.set_credential_file(creds_file, region, authenticate=False)
+    ident = pyrax.identity
+    path = creds_file + TOKEN_CACHE_SUFFIX
+    key = "%s:%s" % (ident.username, region)
+
+    with _locked(path):
+        state = _load(path).get(key)
+        if _valid(state):
+            for attr in IDENTITY_ATTRS:
+                setattr(ident, attr, state[attr])
+            ident.authenticated = True
+            pyrax.regions = tuple(ident.regions)
+            pyrax.services = tuple(ident.services.keys())
+        else:
+            try:
+                ident.authenticate()
+            except e.AuthenticationFailed:
+                pyrax.clear_credentials()
+                raise
+            _save(path, key, _snapshot(ident))
+
+    _record_reauth(ident, path, key)
+    pyrax.default_region = region
+    pyrax.connect_to_services(region=region)
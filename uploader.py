@@ -0,0 +1,846 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fnmatch
+import hashlib
+import json
+import mimetypes
+import mmap
+import os
+import threading
+from Queue import Empty, Full, Queue
+from time import time
+from urllib import quote
+
+import swiftclient
+
+import progress
+
+# Default number of upload workers, each holding its own connection
+DEFAULT_WORKERS = 16
+
+# Files queued ahead of the workers (per worker), bounding the memory used
+# however large the directory being uploaded is
+QUEUE_DEPTH = 8
+
+# Size (in bytes) of the chunks read from a file and sent
+CHUNK_SIZE = 256 * 1024
+
+# Size (in bytes) of the blocks read from a file while hashing it
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Number of objects requested per container listing page
+LISTING_LIMIT = 10000
+
+# Maximum number of objects removed by a single bulk delete request
+BULK_DELETE_LIMIT = 10000
+
+# Default segment size (in bytes) - files larger than this are uploaded in
+# segments, in parallel, and tied together by a large object manifest
+SEGMENT_SIZE = 128 * 1024 * 1024
+
+# Largest single object (and so segment) permitted by Cloud Files
+MAX_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+
+# Most segments a large object manifest may refer to
+MAX_SEGMENTS = 1000
+
+# Suffix of the container segments are stored in (next to the container
+# the large objects themselves are uploaded to)
+SEGMENT_CONTAINER_SUFFIX = "_segments"
+
+# Number of times a single segment is attempted before the upload of the
+# file is given up on (on top of the retries made by the connection)
+SEGMENT_ATTEMPTS = 3
+
+# Files smaller than this (in bytes) are uploaded even when the same content
+# is already in the container, as a copy request costs about as much
+DEDUP_MIN_SIZE = 16 * 1024
+
+
+def _ignored(name, ignore):
+    """
+    Determine whether a file or directory name matches an ignore pattern
+    """
+    return any(fnmatch.fnmatch(name, pattern) for pattern in ignore)
+
+
+def walk_folder(folder, ignore=None):
+    """
+    Yield (path, object name, size) for every file under a folder, object
+    names being the path relative to the folder.  Files and directories
+    matching any of the shell style ignore patterns are skipped.
+    """
+    ignore = ignore or []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames[:] = [d for d in dirnames if not _ignored(d, ignore)]
+        for fname in filenames:
+            if _ignored(fname, ignore):
+                continue
+            path = os.path.join(dirpath, fname)
+            yield path, os.path.relpath(path, folder), os.path.getsize(path)
+
+
+class _Mapped(object):
+    """
+    A byte range of an open file read through a memory map.  Reads hand
+    out buffer slices of the mapping rather than copies, so hashing a file
+    and then sending it reads it from disk once (the send is served from
+    the pages just hashed) and never copies it into Python strings.
+    """
+    def __init__(self, f, offset=0, length=None):
+        if length is None:
+            length = os.fstat(f.fileno()).st_size - offset
+        # Mappings must start on an allocation granularity boundary
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        self.base = offset - start
+        self.length = length
+        self.pos = 0
+        self.mm = None
+        if length:
+            self.mm = mmap.mmap(f.fileno(), self.base + length,
+                                access=mmap.ACCESS_READ, offset=start)
+
+    def md5(self):
+        """
+        Return the MD5 hex digest of the whole range
+        """
+        md5 = hashlib.md5()
+        for pos in xrange(0, self.length, HASH_BLOCK_SIZE):
+            md5.update(buffer(self.mm, self.base + pos,
+                              min(HASH_BLOCK_SIZE, self.length - pos)))
+        return md5.hexdigest()
+
+    def read(self, size=-1):
+        left = self.length - self.pos
+        if size < 0 or size > left:
+            size = left
+        if not size:
+            return ""
+        data = buffer(self.mm, self.base + self.pos, size)
+        self.pos += size
+        return data
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        self.pos = offset
+
+    def close(self):
+        if self.mm:
+            self.mm.close()
+
+
+def file_md5(path):
+    """
+    Return the MD5 hex digest of a file (matching an object's ETag)
+    """
+    with open(path, "rb") as f:
+        return range_md5(f, 0, os.fstat(f.fileno()).st_size)
+
+
+def range_md5(f, offset, length):
+    """
+    Return the MD5 hex digest of a byte range of an open file
+    """
+    m = _Mapped(f, offset, length)
+    try:
+        return m.md5()
+    finally:
+        m.close()
+
+
+def segment_layout(size, segment_size):
+    """
+    Return the segment size used for a file, raised if need be so the
+    file fits within the manifest segment limit
+    """
+    return min(max(segment_size, -(-size // MAX_SEGMENTS)), MAX_OBJECT_SIZE)
+
+
+def large_object_md5(path, size, segment_size):
+    """
+    Return the ETag a file has once uploaded as a large object - the MD5
+    of its segment MD5s joined together
+    """
+    seg = segment_layout(size, segment_size)
+    with open(path, "rb") as f:
+        # The last segment holds whatever is left over
+        md5s = [range_md5(f, offset, min(seg, size - offset))
+                for offset in xrange(0, size, seg)]
+    return hashlib.md5("".join(md5s)).hexdigest()
+
+
+def container_stats(cf, cont):
+    """
+    Return the number of objects in a container and the bytes they use,
+    from a single HEAD request rather than a listing
+    """
+    headers = cf.connection.head_container(cont.name)
+    return (int(headers.get("x-container-object-count", 0)),
+            int(headers.get("x-container-bytes-used", 0)))
+
+
+def clone_connection(conn):
+    """
+    Return a new connection sharing the token and credentials of another
+    """
+    return swiftclient.Connection(authurl=conn.authurl, user=conn.user,
+                                  key=conn.key, retries=conn.retries,
+                                  preauthurl=conn.url, preauthtoken=conn.token,
+                                  auth_version=conn.auth_version,
+                                  os_options=dict(conn.os_options),
+                                  insecure=conn.insecure,
+                                  ssl_compression=conn.ssl_compression)
+
+
+def iter_listing(conn, container, prefix=None, delimiter=None,
+                 limit=LISTING_LIMIT):
+    """
+    Yield every object in a container as a dict of name, bytes, hash and
+    so on (with a delimiter, pseudo-directories are yielded as a dict
+    holding just subdir).  The listing is requested a page at a time by
+    marker, with the next page fetched in the background, on a connection
+    of its own, while the current one is consumed.  At most three pages
+    are held at once however large the container is.
+    """
+    pages = Queue(1)
+    stop = threading.Event()
+
+    def offer(item):
+        # Give up on the page if the caller stops iterating
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except Full:
+                pass
+
+    def fetch():
+        marker = None
+        try:
+            lister = clone_connection(conn)
+            while not stop.is_set():
+                headers, objs = lister.get_container(container, marker=marker,
+                                                     limit=limit,
+                                                     prefix=prefix,
+                                                     delimiter=delimiter)
+                offer(objs)
+                if not objs:
+                    return
+                marker = objs[-1].get("name", objs[-1].get("subdir"))
+        except Exception as err:
+            offer(err)
+
+    fetcher = threading.Thread(target=fetch)
+    fetcher.daemon = True
+    fetcher.start()
+    try:
+        while True:
+            try:
+                # A timeout keeps the caller responsive to Ctrl-C
+                page = pages.get(timeout=1)
+            except Empty:
+                continue
+            if isinstance(page, Exception):
+                raise page
+            if not page:
+                return
+            for obj in page:
+                yield obj
+    finally:
+        stop.set()
+
+
+def container_listing(cf, cont):
+    """
+    Return (size, ETag) for every object in a container, by object name
+    """
+    return dict((o["name"], (o["bytes"], o["hash"]))
+                for o in iter_listing(cf.connection, cont.name))
+
+
+def verify_upload(cf, cont, expected):
+    """
+    Check the objects expected in a container (sizes by object name)
+    against its listing, streamed a page at a time so only the expected
+    names are held.  Returns the names of objects missing from the
+    container and of those present with the wrong size.
+    """
+    remaining = dict(expected)
+    mismatched = []
+    for obj in iter_listing(cf.connection, cont.name):
+        size = remaining.pop(obj["name"], None)
+        if size is not None and size != obj["bytes"]:
+            mismatched.append(obj["name"])
+        if not remaining:
+            break
+    return sorted(remaining), sorted(mismatched)
+
+
+def delete_objects(cf, cont, names):
+    """
+    Remove objects from a container with as few bulk delete requests as
+    possible, returning the number of objects deleted and any errors
+    """
+    deleted, errors = 0, []
+    for pos in xrange(0, len(names), BULK_DELETE_LIMIT):
+        res = cf.bulk_delete(cont, names[pos:pos + BULK_DELETE_LIMIT])
+        deleted += int(res.get("deleted", 0))
+        if res.get("errors"):
+            errors.append(res["errors"])
+    return deleted, errors
+
+
+class _Progress(object):
+    """
+    File wrapper reporting the bytes read from it, so progress is visible
+    while a large file is still being sent.  A retried upload seeks back,
+    which is reported as negative progress.
+    """
+    def __init__(self, f, report):
+        self.f = f
+        self.report = report
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.report(len(data))
+        return data
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, offset, whence=0):
+        pos = self.f.tell()
+        self.f.seek(offset, whence)
+        self.report(self.f.tell() - pos)
+
+
+class _LargeObject(object):
+    """
+    A file being uploaded in segments.  Segment names carry the file size,
+    modification time and segment size, so an interrupted upload of an
+    unmodified file picks up the segments already in place next time.
+    """
+    def __init__(self, path, name, size, st, segment_size, container):
+        self.path = path
+        self.name = name
+        self.size = size
+        self.st = st
+        self.segment_size = segment_layout(size, segment_size)
+        self.count = -(-size // self.segment_size)
+        self.container = container + SEGMENT_CONTAINER_SUFFIX
+        self.prefix = "%s/%d/%d/%d/" % (name, size, int(st.st_mtime),
+                                        self.segment_size)
+        # Segments already uploaded (name to (size, ETag))
+        self.existing = {}
+        self.manifest = [None] * self.count
+        self.remaining = self.count
+        self.failed = None
+        self.started = time()
+
+    def segment(self, num):
+        """
+        Return the offset, length and object name of a segment
+        """
+        offset = num * self.segment_size
+        return (offset, min(self.segment_size, self.size - offset),
+                "%s%08d" % (self.prefix, num))
+
+    def etag(self):
+        """
+        Return the ETag of the complete large object
+        """
+        return hashlib.md5("".join(s["etag"]
+                                   for s in self.manifest)).hexdigest()
+
+
+class Uploader(object):
+    """
+    Upload a directory to a container using a pool of worker threads, each
+    with its own persistent connection to Cloud Files.  A single thread
+    walks the directory and feeds a bounded queue, so directories of any
+    size are handled without listing them in memory.  Failed requests are
+    retried by the connection (with back off and re-authentication).
+
+    Progress is available while the upload runs (uploaded out of total
+    bytes), with the time taken per file kept in results and failures in
+    errors, both by object name.  The workers also feed a progress.Progress
+    as they go, which hands rates, ETA and stalled workers to any listeners
+    provided, so nothing needs to poll.
+
+    Given the container listing (see container_listing), only new or
+    changed files are uploaded.  A file is unchanged if an object of the
+    same name, size and MD5 already exists - the size is compared first so
+    only files that could be unchanged are hashed, with hashing spread
+    across the workers.  With an upload index, files not modified since
+    they were last hashed are not read at all.  Unchanged files count
+    towards progress as they are checked.
+
+    Files are read through memory maps and sent with their MD5, which
+    Cloud Files checks on receipt.  Files larger than the segment size are
+    split into segments which are queued ahead of any other files, so the
+    whole pool works on a large file at once.  Each segment is retried on
+    its own if it fails.  Once all are in place a static large object
+    manifest is uploaded under the file name.
+
+    A publishing stage (see publish) may have files uploaded under other
+    names (names), from elsewhere in place of the local ones (sources) and
+    with extra headers (headers).  Sync compares against the replacement
+    files.
+
+    Files whose content is already in the container, whether uploaded
+    earlier in the run or (when syncing) found in the listing, are created
+    as server side copies of the object holding it rather than sent again.
+    """
+    def __init__(self, cf, cont, workers=DEFAULT_WORKERS,
+                 chunk_size=CHUNK_SIZE, remote=None, index=None,
+                 segment_size=SEGMENT_SIZE, listeners=None, names=None,
+                 sources=None, headers=None, dedup=True):
+        self.connection = cf.connection
+        self.container = cont.name
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.queue = Queue(workers * QUEUE_DEPTH)
+        self.segment_size = segment_size
+        # Segments waiting to be uploaded, the number of large objects still
+        # in progress and the number of files being looked at (any of which
+        # may turn out to be large)
+        self.segments = Queue()
+        self.large = 0
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.threads = []
+        self.total = 0
+        self.uploaded = 0
+        self.results = {}
+        self.errors = {}
+        # Container listing to sync against, and the local names seen
+        self.remote = remote
+        self.seen = set()
+        self.skipped = 0
+        self.skipped_bytes = 0
+        # Upload state index (see uploadindex) the MD5 of files is taken
+        # from, and uploads are recorded in
+        self.index = index
+        # Progress listeners (see progress), fed as the upload runs
+        self.listeners = listeners or []
+        self.progress = None
+        # Object names differing from the local name (e.g. fingerprinted)
+        # by local name, then files uploaded in place of the local ones
+        # (e.g. compressed copies) and extra headers sent with objects, both
+        # by object name
+        self.names = names or {}
+        self.sources = sources or {}
+        self.headers = headers or {}
+        # Object holding each content (MD5 and Content-Encoding) known to be
+        # in the container, so duplicates are copied rather than uploaded,
+        # and the objects copied (size and source, by object name)
+        self.dedup = dedup
+        self.contents = {}
+        for name, (size, etag) in (remote or {}).iteritems():
+            if size >= DEDUP_MIN_SIZE:
+                self.contents.setdefault((etag, None), name)
+        self.copies = {}
+        self.copied_bytes = 0
+        self.started = None
+        self.finished = None
+
+    def _connect(self):
+        """
+        Return a new connection sharing the client's token and credentials
+        """
+        return clone_connection(self.connection)
+
+    def _report(self, nbytes):
+        """
+        Account for bytes sent (or skipped as already in place)
+        """
+        with self.lock:
+            self.uploaded += nbytes
+        self.progress.sent(nbytes, threading.current_thread().name)
+
+    def _completed(self, name, size, secs):
+        """
+        Record a file as uploaded
+        """
+        with self.lock:
+            self.results[name] = (size, secs)
+        self.progress.file_done()
+
+    def _duplicate(self, name, size, key):
+        """
+        Return the name of an object already holding a file's content, or
+        None if the file has to be uploaded
+        """
+        if not self.dedup or size < DEDUP_MIN_SIZE:
+            return None
+        with self.lock:
+            source = self.contents.get(key)
+        return source if source != name else None
+
+    def _copy(self, conn, name, size, source, ctype):
+        """
+        Create an object as a server side copy of another holding the same
+        content, returning False if the copy could not be made
+        """
+        headers = dict(self.headers.get(name) or {})
+        headers["X-Copy-From"] = "/%s/%s" % (quote(self.container),
+                                             quote(source))
+        try:
+            conn.put_object(self.container, name, None, content_type=ctype,
+                            headers=headers)
+        except swiftclient.ClientException:
+            # Most likely the source has gone, upload the file instead
+            return False
+        with self.lock:
+            self.copies[name] = (size, source)
+            self.copied_bytes += size
+        self._report(size)
+        self.progress.file_done()
+        return True
+
+    def _files(self, folder, ignore):
+        """
+        Yield (path, object name, size) for every file to be uploaded,
+        with any renames and replacement source files applied
+        """
+        for path, name, size in walk_folder(folder, ignore):
+            name = self.names.get(name, name)
+            if name in self.sources:
+                path = self.sources[name]
+                size = os.path.getsize(path)
+            yield path, name, size
+
+    def _feed(self, folder, ignore):
+        """
+        Walk the directory, queueing files for the workers
+        """
+        for item in self._files(folder, ignore):
+            if self.remote is not None:
+                self.seen.add(item[1])
+            self.queue.put(item)
+        for _ in xrange(self.workers):
+            self.queue.put(None)
+
+    def _etag(self, path, size):
+        """
+        Return the ETag a file gets once uploaded (a large object's is the
+        MD5 of its segments' MD5s)
+        """
+        if size > self.segment_size:
+            return large_object_md5(path, size, self.segment_size)
+        return file_md5(path)
+
+    def _unchanged(self, path, name, size, st):
+        """
+        Determine whether a file matches the object already uploaded.  The
+        MD5 is taken from the upload index while the file's stat signature
+        is unchanged, so the file is only read if it may have changed.
+        """
+        if not self.remote or name not in self.remote:
+            return False
+        rsize, etag = self.remote[name]
+        if rsize != size:
+            return False
+        md5 = self.index.md5(path, st) if self.index else None
+        if md5 is None:
+            md5 = self._etag(path, size)
+        if md5 != etag:
+            return False
+        if self.index:
+            self.index.uploaded(path, st, md5, self.container)
+        return True
+
+    def _next(self, finished):
+        """
+        Return the next queued segment, or failing that the next queued
+        file.  Once all files have been handed out, wait on segments until
+        no more can turn up and return None.
+        """
+        while True:
+            try:
+                return "segment", self.segments.get_nowait()
+            except Empty:
+                pass
+            if finished:
+                with self.lock:
+                    if not self.large and not self.busy:
+                        return None, None
+                queue = self.segments
+            else:
+                queue = self.queue
+            try:
+                item = queue.get(True, 1)
+            except Empty:
+                continue
+            return ("segment" if queue is self.segments else "file"), item
+
+    def _upload_file(self, conn, path, name, size):
+        """
+        Upload a file, or queue its segments if it is a large one
+        """
+        start = time()
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        if self._unchanged(path, name, size, st):
+            with self.lock:
+                self.skipped += 1
+                self.skipped_bytes += size
+            self._report(size)
+            self.progress.file_done()
+            return
+        if size > self.segment_size:
+            self._split(conn, path, name, size, st)
+            return
+        # The MD5 is sent along so Cloud Files verifies what it receives
+        md5 = self.index.md5(path, st) if self.index else None
+        ctype = mimetypes.guess_type(name)[0]
+        headers = self.headers.get(name)
+        with open(path, "rb") as f:
+            m = _Mapped(f, 0, size)
+            try:
+                md5 = md5 or m.md5()
+                key = (md5, (headers or {}).get("Content-Encoding"))
+                source = self._duplicate(name, size, key)
+                if source and self._copy(conn, name, size, source, ctype):
+                    etag = None
+                else:
+                    etag = conn.put_object(self.container, name,
+                                           _Progress(m, self._report),
+                                           content_length=size, etag=md5,
+                                           chunk_size=self.chunk_size,
+                                           content_type=ctype,
+                                           headers=headers)
+            finally:
+                m.close()
+        if self.index:
+            self.index.uploaded(path, st, md5, self.container)
+        if etag:
+            with self.lock:
+                self.contents.setdefault(key, name)
+            self._completed(name, size, time() - start)
+
+    def _split(self, conn, path, name, size, st):
+        """
+        Queue the segments of a large file, noting any already uploaded
+        """
+        lo = _LargeObject(path, name, size, st, self.segment_size,
+                          self.container)
+        conn.put_container(lo.container)
+        lo.existing = dict((o["name"], (o["bytes"], o["hash"]))
+                           for o in iter_listing(conn, lo.container,
+                                                 prefix=lo.prefix))
+        with self.lock:
+            self.large += 1
+        for num in xrange(lo.count):
+            self.segments.put((lo, num))
+
+    def _upload_segment(self, conn, lo, num):
+        """
+        Upload a single segment unless already in place
+        """
+        offset, length, segname = lo.segment(num)
+        with open(lo.path, "rb") as f:
+            m = _Mapped(f, offset, length)
+            try:
+                md5 = m.md5()
+                if lo.existing.get(segname) == (length, md5):
+                    with self.lock:
+                        self.skipped_bytes += length
+                    self._report(length)
+                else:
+                    self._send_segment(conn, lo, segname, m, md5)
+            finally:
+                m.close()
+        lo.manifest[num] = {"path": "/%s/%s" % (lo.container, segname),
+                            "etag": md5, "size_bytes": length}
+
+    def _send_segment(self, conn, lo, segname, m, md5):
+        """
+        Upload a segment, retrying it on its own should it fail
+        """
+        for attempt in xrange(SEGMENT_ATTEMPTS):
+            m.seek(0)
+            try:
+                conn.put_object(lo.container, segname,
+                                _Progress(m, self._report),
+                                content_length=m.length, etag=md5,
+                                chunk_size=self.chunk_size)
+                return
+            except Exception:
+                # Take back the progress made by the failed attempt
+                self._report(-m.tell())
+                if attempt == SEGMENT_ATTEMPTS - 1:
+                    raise
+
+    def _segment_done(self, conn, lo, err=None):
+        """
+        Account for a finished segment, uploading the manifest once the
+        last of the segments of a large object is in place
+        """
+        with self.lock:
+            if err and not lo.failed:
+                lo.failed = err
+            lo.remaining -= 1
+            if lo.remaining:
+                return
+        try:
+            if lo.failed:
+                raise lo.failed
+            conn.put_object(self.container, lo.name, json.dumps(lo.manifest),
+                            content_type=mimetypes.guess_type(lo.name)[0],
+                            headers=self.headers.get(lo.name),
+                            query_string="multipart-manifest=put")
+            if self.index:
+                self.index.uploaded(lo.path, lo.st, lo.etag(), self.container)
+            self._completed(lo.name, lo.size, time() - lo.started)
+        except Exception as failure:
+            with self.lock:
+                self.errors[lo.name] = failure
+        finally:
+            with self.lock:
+                self.large -= 1
+
+    def _work(self):
+        """
+        Worker thread body, uploading queued segments and files until there
+        are none left
+        """
+        conn = self._connect()
+        worker = threading.current_thread().name
+        finished = False
+        while True:
+            self.progress.idle(worker)
+            kind, item = self._next(finished)
+            if kind is None:
+                break
+            elif kind == "segment":
+                self.progress.busy(worker)
+                lo, num = item
+                try:
+                    self._upload_segment(conn, lo, num)
+                except Exception as err:
+                    self._segment_done(conn, lo, err)
+                else:
+                    self._segment_done(conn, lo)
+            elif item is None:
+                finished = True
+            else:
+                path, name, size = item
+                self.progress.busy(worker)
+                with self.lock:
+                    self.busy += 1
+                try:
+                    self._upload_file(conn, path, name, size)
+                except Exception as err:
+                    with self.lock:
+                        self.errors[name] = err
+                finally:
+                    with self.lock:
+                        self.busy -= 1
+
+    def start(self, folder, ignore=None):
+        """
+        Start uploading the contents of a folder in the background,
+        returning the total number of bytes to be uploaded
+        """
+        self.total = sum(size for _, _, size in self._files(folder, ignore))
+        self.progress = progress.Progress(self.total, self.listeners)
+        self.started = time()
+        feeder = threading.Thread(target=self._feed, args=(folder, ignore))
+        self.threads = [feeder] + [threading.Thread(target=self._work)
+                                   for _ in xrange(self.workers)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+        return self.total
+
+    def stale(self):
+        """
+        Return the names of objects with no matching local file (only known
+        once the upload has finished, and only when syncing)
+        """
+        if not self.remote:
+            return []
+        return sorted(set(self.remote) - self.seen)
+
+    def join(self):
+        """
+        Wait for the upload to finish
+        """
+        for t in self.threads:
+            # A timeout keeps the main thread responsive to Ctrl-C
+            while t.is_alive():
+                t.join(1)
+        if self.finished is None:
+            self.finished = time()
+            self.progress.finish()
+
+    def elapsed(self):
+        """
+        Return the time (in seconds) the upload has been running for
+        """
+        return (self.finished or time()) - self.started
+
+    def rate(self):
+        """
+        Return the aggregate upload rate in bytes per second
+        """
+        elapsed = self.elapsed()
+        sent = self.uploaded - self.skipped_bytes - self.copied_bytes
+        return sent / elapsed if elapsed else 0.0
+
+    def file_rates(self):
+        """
+        Return the upload rate (bytes per second) of each file uploaded
+        """
+        return dict((name, size / secs if secs else 0.0)
+                    for name, (size, secs) in self.results.iteritems())
+
+    def sizes(self):
+        """
+        Return the size of every object uploaded or copied, by object name
+        """
+        sizes = dict((name, size)
+                     for name, (size, secs) in self.results.iteritems())
+        sizes.update((name, size)
+                     for name, (size, source) in self.copies.iteritems())
+        return sizes
+
+    def summary(self):
+        """
+        Return lines describing the aggregate and per-file throughput
+        """
+        mb = 1024.0 * 1024
+        lines = ["Uploaded %d file(s), %.2f MB in %.1fs (%.2f MB/s)"
+                 % (len(self.results),
+                    (self.uploaded - self.skipped_bytes -
+                     self.copied_bytes) / mb,
+                    self.elapsed(), self.rate() / mb)]
+        if self.remote is not None:
+            lines.append("Skipped %d unchanged file(s), %.2f MB"
+                         % (self.skipped, self.skipped_bytes / mb))
+        if self.copies:
+            lines.append("Copied %d duplicate file(s) server side, saving "
+                         "%.2f MB" % (len(self.copies),
+                                      self.copied_bytes / mb))
+        rates = sorted(self.file_rates().values())
+        if rates:
+            lines.append("Per file throughput: min %.2f MB/s, median %.2f "
+                         "MB/s, max %.2f MB/s"
+                         % (rates[0] / mb, rates[len(rates) / 2] / mb,
+                            rates[-1] / mb))
+        return lines
@@ -0,0 +1,140 @@
+# Copyright 2013 Adnan Smajlovic
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from time import time
+
+import catalog
+
+# Location of the upload state index (kept with the catalog cache)
+INDEX_FILE = "uploads.db"
+
+# Number of rows held back and written in a single transaction
+BATCH_SIZE = 1000
+
+# Upload state of a local file
+Entry = namedtuple("Entry", "size mtime inode md5 container uploaded")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    inode INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    container TEXT,
+    uploaded REAL
+)
+"""
+
+
+def signature(st):
+    """
+    Return the (size, mtime, inode) stat signature of a file
+    """
+    return st.st_size, st.st_mtime, st.st_ino
+
+
+class UploadIndex(object):
+    """
+    Persistent record of the MD5 of every local file hashed or uploaded,
+    along with the stat signature it had at the time and where it was last
+    uploaded to.  A file whose signature is unchanged does not need to be
+    read again to learn its MD5.
+
+    Lookups are primary key reads (rows held back are looked at first).
+    Writes are held back and committed a batch at a time, so recording
+    millions of files costs a few thousand transactions rather than
+    millions.  One connection is shared by all threads, serialised by a
+    lock.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            cache_dir = os.path.expanduser(catalog.CACHE_DIR)
+            try:
+                os.makedirs(cache_dir, 0700)
+            except OSError:
+                pass
+            path = os.path.join(cache_dir, INDEX_FILE)
+        self.lock = threading.Lock()
+        # Rows held back (not yet written), keyed by path
+        self.pending = {}
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Write ahead logging lets several runs read while one writes
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def get(self, path):
+        """
+        Return the entry for a file, or None if it has not been seen
+        """
+        with self.lock:
+            row = self.pending.get(path)
+            if row:
+                return Entry(*row[1:])
+            row = self.db.execute("SELECT size, mtime, inode, md5, container,"
+                                  " uploaded FROM files WHERE path = ?",
+                                  (path,)).fetchone()
+        return Entry(*row) if row else None
+
+    def md5(self, path, st):
+        """
+        Return the recorded MD5 of a file if its stat signature is unchanged
+        """
+        entry = self.get(path)
+        if entry and (entry.size, entry.mtime, entry.inode) == signature(st):
+            return entry.md5
+        return None
+
+    def record(self, path, st, md5, container=None, uploaded=None):
+        """
+        Record the MD5 of a file (and where it was uploaded to, if it was)
+        """
+        with self.lock:
+            self.pending[path] = ((path,) + signature(st) +
+                                  (md5, container, uploaded))
+            if len(self.pending) >= BATCH_SIZE:
+                self._flush()
+
+    def uploaded(self, path, st, md5, container):
+        """
+        Record a file as uploaded to a container just now
+        """
+        self.record(path, st, md5, container, time())
+
+    def _flush(self):
+        """
+        Write out held back rows in a single transaction (lock held)
+        """
+        if not self.pending:
+            return
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO files (path, size, "
+                                "mtime, inode, md5, container, uploaded) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                self.pending.itervalues())
+        self.pending = {}
+
+    def close(self):
+        """
+        Write out anything held back and close the index
+        """
+        with self.lock:
+            self._flush()
+            self.db.close()